@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+# Compare the CPU time and memory used to decode a large list response
+# and read the metadata of each object, between wrapping the response
+# in the objects the dynamic client uses, and decoding it into records
+# holding just the type and metadata of each object.
+#
+#   python3 benchmarks/decode-lists.py [--objects=N] [--cycles=N]
+#
+# Memory is measured using tracemalloc, with the peak being the most
+# allocated while decoding, and retained being what is still held by
+# the result afterwards.
+
+import argparse
+import json
+import os
+import time
+import tracemalloc
+
+from openshift.dynamic.resource import ResourceInstance
+
+helpers_root = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        '..', 'helpers')
+
+with open(os.path.join(helpers_root, 'records.py')) as fp:
+    exec(compile(fp.read(), os.path.join(helpers_root, 'records.py'),
+            'exec'), globals())
+
+def generate_namespace(index):
+    username = 'user%d' % index
+    name = 'lab-%s' % username
+
+    return {
+        'kind': 'Namespace',
+        'apiVersion': 'v1',
+        'metadata': {
+            'name': name,
+            'uid': '2a1c4e8e-0000-4000-8000-%012d' % index,
+            'resourceVersion': str(100000 + index),
+            'creationTimestamp': '2020-05-01T00:00:00Z',
+            'labels': {
+                'app': 'lab',
+                'spawner': 'learning-portal',
+                'class': 'session',
+                'user': username
+            },
+            'annotations': {
+                'openshift.io/sa.scc.mcs': 's0:c26,c0',
+                'openshift.io/sa.scc.supplemental-groups': '1000660000/10000',
+                'openshift.io/sa.scc.uid-range': '1000660000/10000',
+                'spawner/requestor': 'system:serviceaccount:workshops:lab-spawner',
+                'spawner/namespace': 'workshops',
+                'spawner/deployment': 'lab',
+                'spawner/account': name,
+                'spawner/session': 'lab-%s' % username
+            },
+            'ownerReferences': [{
+                'apiVersion': 'v1',
+                'kind': 'ClusterRole',
+                'blockOwnerDeletion': False,
+                'controller': True,
+                'name': 'lab-spawner-extra',
+                'uid': '9f3b6f1a-0000-4000-8000-000000000000'
+            }]
+        },
+        'spec': {
+            'finalizers': ['kubernetes']
+        },
+        'status': {
+            'phase': 'Active'
+        }
+    }
+
+def generate_response(count):
+    data = {
+        'kind': 'NamespaceList',
+        'apiVersion': 'v1',
+        'metadata': {
+            'resourceVersion': str(100000 + count)
+        },
+        'items': [generate_namespace(index) for index in range(count)]
+    }
+
+    return json.dumps(data).encode('UTF-8')
+
+def decode_dynamic(content):
+    result = ResourceInstance(None, json.loads(content))
+
+    for item in result.items:
+        annotations = item.metadata.annotations
+        annotations['spawner/requestor'], annotations['spawner/session']
+
+    return result
+
+def decode_records(content):
+    data = json_loads(content)
+
+    result = [ObjectRecord(item) for item in data['items']]
+
+    for item in result:
+        annotations = item.metadata.annotations
+        annotations.get('spawner/requestor'), annotations.get('spawner/session')
+
+    return result
+
+def measure(func, content, cycles):
+    start = time.process_time()
+
+    for _ in range(cycles):
+        func(content)
+
+    cpu = (time.process_time() - start) / cycles
+
+    tracemalloc.start()
+
+    result = func(content)
+
+    retained, peak = tracemalloc.get_traced_memory()
+
+    tracemalloc.stop()
+
+    del result
+
+    return cpu, peak, retained
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--objects', type=int, default=5000)
+    parser.add_argument('--cycles', type=int, default=5)
+
+    args = parser.parse_args()
+
+    content = generate_response(args.objects)
+
+    print('Response size: %d bytes, %d objects' % (len(content),
+            args.objects))
+
+    results = [
+        ('Dynamic client objects', measure(decode_dynamic, content,
+                args.cycles)),
+        ('Metadata records', measure(decode_records, content, args.cycles)),
+    ]
+
+    for name, (cpu, peak, retained) in results:
+        print('%s: %.1fms CPU, %.1fMB peak, %.1fMB retained per cycle' % (
+                name, 1000*cpu, peak/1024/1024, retained/1024/1024))
+
+    (cpu1, peak1, _), (cpu2, peak2, _) = [result for _, result in results]
+
+    if cpu2 <= cpu1:
+        speed = '%.1fx faster' % (cpu1/max(cpu2, 1e-9))
+    else:
+        speed = '%.1fx slower' % (cpu2/max(cpu1, 1e-9))
+
+    if peak2 <= peak1:
+        memory = '%.1fx less' % (peak1/max(peak2, 1))
+    else:
+        memory = '%.1fx more' % (peak2/max(peak1, 1))
+
+    print('Records are %s using %s peak memory' % (speed, memory))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# Compare the CPU time taken to render the extra resources for a session
+# by substituting values into the text of the template and parsing the
+# result, against rendering a template which has been parsed in advance.
+#
+#   python3 benchmarks/render-templates.py [--resources=N] [--sessions=N]
+#
+# If --file is supplied, it will be used as the extra resources template
+# rather than generating one.
+
+import argparse
+import json
+import os
+import string
+import time
+
+import yaml
+
+helpers_root = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        '..', 'helpers')
+
+with open(os.path.join(helpers_root, 'templates.py')) as fp:
+    exec(compile(fp.read(), os.path.join(helpers_root, 'templates.py'),
+            'exec'), globals())
+
+resource_template = """
+- apiVersion: v1
+  kind: ConfigMap
+  metadata:
+    name: settings-%(index)d
+    namespace: ${project_namespace}
+    labels:
+      app: ${application_name}
+      user: ${username}
+  data:
+    registry: ${image_registry}
+    account: ${service_account}
+    spawner: ${spawner_namespace}
+- apiVersion: rbac.authorization.k8s.io/v1
+  kind: RoleBinding
+  metadata:
+    name: ${username}-view-%(index)d
+    namespace: ${project_namespace}
+  roleRef:
+    apiGroup: rbac.authorization.k8s.io
+    kind: ClusterRole
+    name: view
+  subjects:
+  - kind: ServiceAccount
+    name: ${service_account}
+    namespace: ${spawner_namespace}
+"""
+
+def generate_template(count):
+    return ''.join(resource_template % dict(index=index)
+            for index in range(count)).strip()
+
+def values_for_session(index):
+    username = 'user%d' % index
+
+    return dict(spawner_namespace='workshops',
+            project_namespace='lab-%s' % username,
+            image_registry='image-registry.openshift-image-registry.svc:5000',
+            service_account='lab-%s' % username, username=username,
+            application_name='lab')
+
+def render_text(template, loader, values):
+    text = string.Template(template).safe_substitute(values)
+    return loader(text)
+
+def measure(func, sessions):
+    start = time.process_time()
+
+    for index in range(sessions):
+        func(values_for_session(index))
+
+    return time.process_time() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resources', type=int, default=250)
+    parser.add_argument('--sessions', type=int, default=50)
+    parser.add_argument('--file')
+
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file) as fp:
+            template = fp.read().strip()
+        loader = args.file.endswith('.json') and json.loads or yaml.safe_load
+    else:
+        template = generate_template(args.resources // 2)
+        loader = yaml.safe_load
+
+    print('Template size: %d bytes' % len(template))
+
+    start = time.process_time()
+    compiled = ResourceTemplate(template, loader)
+    compile_time = time.process_time() - start
+
+    if not compiled.compiled:
+        print('Template cannot be parsed until values are substituted.')
+        return
+
+    # Check both approaches yield the same result before timing them.
+
+    values = values_for_session(0)
+
+    if render_text(template, loader, values) != compiled.render(**values):
+        print('WARNING: Rendered resources differ between methods.')
+
+    text_time = measure(lambda values: render_text(template, loader,
+            values), args.sessions)
+
+    compiled_time = measure(lambda values: compiled.render(**values),
+            args.sessions)
+
+    print('One off parse of template: %.2fms' % (1000*compile_time))
+
+    print('Substitute and parse: %.3fms per session' % (
+            1000*text_time/args.sessions))
+    print('Precompiled template: %.3fms per session' % (
+            1000*compiled_time/args.sessions))
+
+    print('CPU saved per session: %.3fms (%.0fx faster)' % (
+            1000*(text_time-compiled_time)/args.sessions,
+            text_time/max(compiled_time, 1e-9)))
+
+if __name__ == '__main__':
+    main()
@@ -120,6 +120,20 @@ c.Spawner.environment['WORKSHOP_FILE'] = os.environ.get('WORKSHOP_FILE', '')
 
 c.KubeSpawner.service_account = '%s-session' % application_name
 
+# Release capacity held by a standby pod for use by the session when the
+# pod for the session is being created, if the scheduler can't preempt
+# standby pods to make room for it.
+
+@gen.coroutine
+def modify_pod_hook(spawner, pod):
+    yield release_standby_pod(pod)
+
+    return pod
+
+c.KubeSpawner.modify_pod_hook = modify_pod_hook
+
+enable_standby_pool()
+
 # Setup culling of terminal instances if timeout parameter is supplied.
 
 idle_timeout = os.environ.get('IDLE_TIMEOUT')
@@ -137,7 +151,13 @@ if idle_timeout and int(idle_timeout):
             'environment': dict(
                 ENV="/opt/app-root/etc/profile",
                 BASH_ENV="/opt/app-root/etc/profile",
-                PROMPT_COMMAND=". /opt/app-root/etc/profile"
+                PROMPT_COMMAND=". /opt/app-root/etc/profile",
+                APPLICATION_NAME=application_name,
+                KUBERNETES_SERVICE_HOST=kubernetes_service_host,
+                KUBERNETES_SERVICE_PORT=kubernetes_service_port,
+                IDLE_POLICY=os.environ.get('IDLE_POLICY', 'activity'),
+                IDLE_CPU_THRESHOLD=os.environ.get('IDLE_CPU_THRESHOLD', '10'),
+                CULLER_METRICS_PORT=os.environ.get('CULLER_METRICS_PORT', '0')
             ),
         }
     ])
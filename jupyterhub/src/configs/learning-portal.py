@@ -13,8 +13,10 @@
 # user name. The special '/restart' URL handler will cause any session
 # to be restarted and they will be given a new instance.
 
+import datetime
 import functools
 import random
+import types
 import weakref
 
 from tornado import web
@@ -78,7 +80,14 @@ class AutoAuthenticateHandler(BaseHandler):
                 return self.redirect('/')
 
         else:
-            username = self.generate_user()
+            # Use a session environment from the warm pool if one is
+            # available, otherwise generate a new user name.
+
+            username = yield claim_warm_environment()
+
+            if not username:
+                username = self.generate_user()
+
             raw_user = self.user_from_username(username)
             self.set_login_cookie(raw_user)
 
@@ -232,61 +241,118 @@ c.Spawner.environment['RESTART_URL'] = '/restart'
 
 # Intercept creation of pod and used it to trigger our customisations.
 
-project_owner_name = '%s-spawner-extra' % application_name
-
 try:
-    project_owner = cluster_role_resource.get(project_owner_name)
+    project_owner = startup_result('project-owner')
 
 except Exception as e:
     print('ERROR: Cannot get spawner cluster role %s. %s' % (project_owner_name, e))
     raise
 
 @gen.coroutine
-def modify_pod_hook(spawner, pod):
+def provision_session(spawner, pod):
     short_name = spawner.user.name
     user_account_name = '%s-%s' % (application_name, short_name)
 
     project_name = '%s-%s' % (application_name, short_name)
 
-    pod.spec.automount_service_account_token = True
-    pod.spec.service_account_name = user_account_name
+    resource_budget = os.environ.get('RESOURCE_BUDGET', 'default')
 
-    # Ensure that a service account exists corresponding to the user.
-    # Need to do this as it may have been cleaned up if the session had
-    # expired and user wasn't logged out in the browser.
+    # The steps for provisioning the session are run as stages, with
+    # those which don't depend on each other being run concurrently.
 
-    owner_uid = yield create_service_account(spawner, pod)
+    stages = {
+        # Ensure that a service account exists corresponding to the user.
+        # Need to do this as it may have been cleaned up if the session
+        # had expired and user wasn't logged out in the browser.
 
-    # If there are any exposed ports defined for the session, create
-    # a service object mapping to the pod for the ports, and create
-    # routes for each port.
+        'service-account': ((),
+            lambda results: create_service_account(spawner, pod)),
 
-    yield expose_service_ports(spawner, pod, owner_uid)
+        # If there are any exposed ports defined for the session, create
+        # a service object mapping to the pod for the ports, and create
+        # routes for each port.
 
-    # Create a project for just this user. Poll to make sure it is
-    # created before continue.
+        'service-ports': (('service-account',),
+            lambda results: expose_service_ports(spawner, pod,
+                    results['service-account'])),
 
-    yield create_project_namespace(spawner, pod, project_name)
+        # Create a project for just this user.
 
-    # Now set up the project permissions and resource budget.
+        'project-namespace': ((),
+            lambda results: create_project_namespace(spawner, pod,
+                    project_name)),
 
-    resource_budget = os.environ.get('RESOURCE_BUDGET', 'default')
+        # Now set up the project permissions and resource budget. This
+        # will wait to make sure the project is created before continuing.
+
+        'project-setup': (('project-namespace',),
+            lambda results: setup_project_namespace(spawner, pod,
+                    project_name, 'admin', resource_budget)),
+
+        # Before can continue, need to poll looking to see if the secret
+        # for the api token has been added to the service account. If
+        # don't do this then pod creation will fail immediately. To do
+        # this, must get the secrets from the service account and make
+        # sure they in turn exist.
+
+        'account-ready': (('service-account',),
+            lambda results: wait_on_service_account(user_account_name,
+                    priority=spawner_priority(spawner))),
+
+        # Create any extra resources in the project required for a
+        # workshop.
+
+        'extra-resources': (('project-setup', 'account-ready'),
+            lambda results: create_extra_resources(spawner, pod,
+                    project_name, results['project-setup'],
+                    user_account_name, short_name)),
+    }
+
+    results = yield run_stages(stages)
+
+    return results
+
+@gen.coroutine
+def modify_pod_hook(spawner, pod):
+    short_name = spawner.user.name
+    user_account_name = '%s-%s' % (application_name, short_name)
+
+    project_name = '%s-%s' % (application_name, short_name)
+
+    pod.spec.automount_service_account_token = True
+    pod.spec.service_account_name = user_account_name
+
+    # Release capacity held by a standby pod for use by this session
+    # while the session is being provisioned, if the scheduler can't
+    # preempt standby pods to make room for it.
+
+    standby = release_standby_pod(pod)
+
+    # If the user was given an environment from the warm pool, it will
+    # already have been provisioned. Check that the project still exists
+    # in case it was cleaned up in the meantime, and if it has been, or
+    # the user didn't come from the warm pool, provision a new one.
 
-    project_uid = yield setup_project_namespace(spawner, pod, project_name,
-            'admin', resource_budget)
+    provisioned = False
 
-    # Before can continue, need to poll looking to see if the secret for
-    # the api token has been added to the service account. If don't do
-    # this then pod creation will fail immediately. To do this, must get
-    # the secrets from the service account and make sure they in turn
-    # exist.
+    if short_name in warm_pool_claimed:
+        warm_pool_claimed.discard(short_name)
 
-    yield wait_on_service_account(user_account_name)
+        try:
+            project = yield api_call(namespace_resource.get,
+                    name=project_name)
 
-    # Create any extra resources in the project required for a workshop.
+            provisioned = project.status.phase == 'Active'
 
-    yield create_extra_resources(spawner, pod, project_name, project_uid,
-            user_account_name, short_name)
+        except ApiException as e:
+            if e.status != 404:
+                print('ERROR: Error querying project. %s' % e)
+                raise
+
+    if not provisioned:
+        yield provision_session(spawner, pod)
+
+    yield standby
 
     # Add environment variable for the project namespace for use in any
     # workshop content.
@@ -310,6 +376,148 @@ def modify_pod_hook(spawner, pod):
 
 c.KubeSpawner.modify_pod_hook = modify_pod_hook
 
+enable_standby_pool()
+
+# Maintain a pool of session environments which are provisioned ahead of
+# time, so that a new user only needs to wait on their pod being started.
+# Each environment is provisioned under a generated user name, and once
+# ready, the project is annotated as being available. When a new user
+# arrives they are given the user name for one of the environments and
+# the project annotation updated to say it has been claimed. Projects
+# with the available annotation are ignored by the service which cleans
+# up projects, but once claimed they are treated like any other.
+
+warm_pool_size = int(os.environ.get('WARM_POOL_SIZE', '0'))
+
+warm_pool = []
+warm_pool_pending = set()
+warm_pool_claimed = set()
+
+def generate_warm_userid():
+    while True:
+        name = generate_random_userid()
+        user = get_user_details(name)
+        if not user.active:
+            user.active = True
+            return name
+
+@gen.coroutine
+def annotate_warm_environment(name, state, priority=None):
+    project_name = '%s-%s' % (application_name, name)
+
+    body = {
+        'metadata': {
+            'name': project_name,
+            'annotations': {
+                'spawner/pool': state
+            }
+        }
+    }
+
+    yield api_call(namespace_resource.patch, body=body,
+            content_type='application/merge-patch+json', priority=priority)
+
+@gen.coroutine
+def provision_warm_environment():
+    name = generate_warm_userid()
+
+    # The provisioning functions expect to be passed the spawner and
+    # pod, so pass stand ins which provide the details they need. The
+    # stand in for the spawner also says that requests should be made
+    # at a lower priority than those for users who are waiting.
+
+    spawner = types.SimpleNamespace(user=types.SimpleNamespace(name=name),
+            api_priority='gc')
+
+    pod_name = c.KubeSpawner.pod_name_template.format(username=name)
+    pod = types.SimpleNamespace(metadata=types.SimpleNamespace(name=pod_name))
+
+    warm_pool_pending.add(name)
+
+    try:
+        yield provision_session(spawner, pod)
+        yield annotate_warm_environment(name, 'available', priority='gc')
+
+    except Exception as e:
+        # The project isn't marked as available, so anything which was
+        # created will be cleaned up as for an expired session.
+
+        print('ERROR: Failed to provision warm environment %s. %s' % (name, e))
+
+    else:
+        print('INFO: Added environment %s to warm pool.' % name)
+
+        warm_pool.append(name)
+
+    finally:
+        warm_pool_pending.discard(name)
+
+@gen.coroutine
+def replenish_warm_pool():
+    shortfall = warm_pool_size - len(warm_pool) - len(warm_pool_pending)
+
+    if shortfall > 0:
+        yield [provision_warm_environment() for _ in range(shortfall)]
+
+@gen.coroutine
+def claim_warm_environment():
+    while warm_pool:
+        name = warm_pool.pop(0)
+
+        try:
+            yield annotate_warm_environment(name, 'claimed')
+
+        except Exception as e:
+            print('ERROR: Failed to claim warm environment %s. %s' % (name, e))
+
+            continue
+
+        print('INFO: Claimed environment %s from warm pool.' % name)
+
+        warm_pool_claimed.add(name)
+
+        IOLoop.current().add_callback(replenish_warm_pool)
+
+        return name
+
+@gen.coroutine
+def adopt_warm_environments():
+    # Environments may have been left in the pool by a prior instance of
+    # JupyterHub, so add those back into the pool.
+
+    try:
+        projects = yield background_api_call(namespace_resource.get,
+                label_selector='app=%s,class=session' % application_name)
+
+    except Exception as e:
+        print('ERROR: Failed to query warm environments. %s' % e)
+
+        return
+
+    for project in projects.items:
+        annotations = project.metadata.annotations
+        if annotations and annotations['spawner/pool'] == 'available':
+            if (annotations['spawner/requestor'] == full_service_account_name and
+                    annotations['spawner/namespace'] == namespace and
+                    annotations['spawner/deployment'] == application_name):
+                name = project.metadata.labels['user']
+
+                get_user_details(name).active = True
+
+                print('INFO: Adopted environment %s into warm pool.' % name)
+
+                warm_pool.append(name)
+
+@gen.coroutine
+def start_warm_pool():
+    yield adopt_warm_environments()
+    yield replenish_warm_pool()
+
+    PeriodicCallback(replenish_warm_pool, 15*1000).start()
+
+if warm_pool_size > 0:
+    IOLoop.current().add_callback(start_warm_pool)
+
 # Setup culling of terminal instances when idle or session expires, as
 # well as setup service to clean up service accounts and projects
 # related to old sessions. If a server limit is defined, also cap how
@@ -320,13 +528,108 @@ server_limit = os.environ.get('SERVER_LIMIT')
 if server_limit:
     c.JupyterHub.active_server_limit = int(server_limit)
 
+# When the server limit has been reached, rather than rejecting a request
+# for a new session, make room by stopping the sessions which have gone
+# the longest without activity, provided they have been idle for at
+# least the eviction idle timeout. Otherwise a new user would have to
+# wait for the idle sessions to be culled. Eviction is disabled if the
+# timeout is not set, while a timeout of 0 allows any idle session to be
+# evicted.
+
+eviction_idle_timeout = os.environ.get('EVICTION_IDLE_TIMEOUT', '')
+
+if eviction_idle_timeout:
+    eviction_idle_timeout = int(eviction_idle_timeout)
+else:
+    eviction_idle_timeout = None
+
+eviction_lock = Lock()
+
+@gen.coroutine
+def evict_idle_servers(handler, count):
+    now = datetime.datetime.utcnow()
+
+    candidates = []
+
+    for user in list(handler.users.values()):
+        for server_name, spawner in list(user.spawners.items()):
+            if spawner.pending or not spawner.ready:
+                continue
+
+            last_activity = spawner.last_activity or spawner.orm_spawner.started
+
+            if last_activity is None:
+                continue
+
+            idle = (now - last_activity).total_seconds()
+
+            if idle >= eviction_idle_timeout:
+                candidates.append((last_activity, user, server_name))
+
+    candidates.sort(key=lambda candidate: candidate[0])
+
+    stops = []
+
+    for last_activity, user, server_name in candidates[:count]:
+        print('INFO: Evicting session for %s, idle since %s.' % (
+                user.name, last_activity))
+
+        stops.append(handler.stop_single_user(user, server_name))
+
+    if stops:
+        yield stops
+
+    return len(stops)
+
+# The lock is held until the spawn has been registered as pending, and so
+# counts as active, as otherwise a concurrent spawn could count the same
+# freed slot. JupyterHub may wait to refresh the user's authentication
+# before it gets that far, so the spawn is checked for periodically.
+
+def _spawn_single_user_args(user, server_name='', options=None):
+    return user, server_name
+
+if server_limit and eviction_idle_timeout is not None:
+    @wrapt.patch_function_wrapper('jupyterhub.handlers.base', 'BaseHandler.spawn_single_user')
+    @gen.coroutine
+    def _wrapper_spawn_single_user(wrapped, instance, args, kwargs):
+        active_server_limit = instance.active_server_limit
+
+        if not active_server_limit:
+            result = yield wrapped(*args, **kwargs)
+            return result
+
+        user, server_name = _spawn_single_user_args(*args, **kwargs)
+
+        with (yield eviction_lock.acquire()):
+            active = instance.users.count_active_users()['active']
+
+            if active >= active_server_limit:
+                evicted = yield evict_idle_servers(instance,
+                        active - active_server_limit + 1)
+
+                if not evicted:
+                    print('WARNING: Server limit reached with no sessions '
+                            'idle long enough to evict.')
+
+            spawn_future = gen.convert_yielded(wrapped(*args, **kwargs))
+
+            while not spawn_future.done():
+                if (server_name in user.spawners and
+                        user.spawners[server_name].pending):
+                    break
+                yield gen.sleep(0.1)
+
+        result = yield spawn_future
+
+        return result
+
 idle_timeout = os.environ.get('IDLE_TIMEOUT', '600')
 max_session_age = os.environ.get('MAX_SESSION_AGE')
 
 if idle_timeout and int(idle_timeout):
     cull_idle_servers_cmd = ['/opt/app-root/src/scripts/cull-idle-servers.sh']
 
-    cull_idle_servers_cmd.append('--cull-every=60')
     cull_idle_servers_cmd.append('--timeout=%s' % idle_timeout)
     cull_idle_servers_cmd.append('--cull-users')
 
@@ -341,11 +644,34 @@ if idle_timeout and int(idle_timeout):
             'environment': dict(
                 ENV="/opt/app-root/etc/profile",
                 BASH_ENV="/opt/app-root/etc/profile",
-                PROMPT_COMMAND=". /opt/app-root/etc/profile"
+                PROMPT_COMMAND=". /opt/app-root/etc/profile",
+                APPLICATION_NAME=application_name,
+                KUBERNETES_SERVICE_HOST=kubernetes_service_host,
+                KUBERNETES_SERVICE_PORT=kubernetes_service_port,
+                IDLE_POLICY=os.environ.get('IDLE_POLICY', 'activity'),
+                IDLE_CPU_THRESHOLD=os.environ.get('IDLE_CPU_THRESHOLD', '10'),
+                CULLER_METRICS_PORT=os.environ.get('CULLER_METRICS_PORT', '0')
             ),
         }
     ])
 
+    # The service which deletes projects makes its own requests against
+    # the REST API, which JupyterHub can't prioritise against its own, so
+    # give it a separate smaller budget. Unless set, this is a fifth of
+    # the overall rate, with what JupyterHub can use reduced to match, so
+    # that the two together don't exceed the overall rate.
+
+    deletion_request_rate = float(os.environ.get('DELETION_REQUEST_RATE',
+            api_request_rate * 0.2))
+
+    if api_request_rate > 0:
+        if 0 < deletion_request_rate < api_request_rate:
+            api_request_limiter.set_rate(api_request_rate -
+                    deletion_request_rate, api_request_burst)
+        else:
+            print('WARNING: Deletion request rate should be more than zero '
+                    'and less than the overall rate of %s.' % api_request_rate)
+
     delete_projects_cmd = ['/opt/app-root/src/scripts/delete-projects.sh']
 
     c.JupyterHub.services.extend([
@@ -358,7 +684,12 @@ if idle_timeout and int(idle_timeout):
                 PROMPT_COMMAND=". /opt/app-root/etc/profile",
                 APPLICATION_NAME=application_name,
                 KUBERNETES_SERVICE_HOST=kubernetes_service_host,
-                KUBERNETES_SERVICE_PORT=kubernetes_service_port
+                KUBERNETES_SERVICE_PORT=kubernetes_service_port,
+                DELETION_WORKERS=os.environ.get('DELETION_WORKERS', '8'),
+                DELETION_RATE=os.environ.get('DELETION_RATE', '10'),
+                DELETION_REQUEST_RATE='%s' % deletion_request_rate,
+                DELETION_REQUEST_BURST=os.environ.get(
+                        'DELETION_REQUEST_BURST', '0')
             ),
         }
     ])
@@ -208,7 +208,13 @@ if idle_timeout and int(idle_timeout):
             'environment': dict(
                 ENV="/opt/app-root/etc/profile",
                 BASH_ENV="/opt/app-root/etc/profile",
-                PROMPT_COMMAND=". /opt/app-root/etc/profile"
+                PROMPT_COMMAND=". /opt/app-root/etc/profile",
+                APPLICATION_NAME=application_name,
+                KUBERNETES_SERVICE_HOST=kubernetes_service_host,
+                KUBERNETES_SERVICE_PORT=kubernetes_service_port,
+                IDLE_POLICY=os.environ.get('IDLE_POLICY', 'activity'),
+                IDLE_CPU_THRESHOLD=os.environ.get('IDLE_CPU_THRESHOLD', '10'),
+                CULLER_METRICS_PORT=os.environ.get('CULLER_METRICS_PORT', '0')
             ),
         }
     ])
@@ -173,10 +173,8 @@ c.Spawner.environment['CONSOLE_URL'] = 'http://localhost:10083'
 c.Spawner.environment['DOWNLOAD_URL'] = os.environ.get('DOWNLOAD_URL', '')
 c.Spawner.environment['WORKSHOP_FILE'] = os.environ.get('WORKSHOP_FILE', '')
 
-project_owner_name = '%s-spawner-extra' % application_name
-
 try:
-    project_owner = cluster_role_resource.get(project_owner_name)
+    project_owner = startup_result('project-owner')
 
 except Exception as e:
     print('ERROR: Cannot get spawner cluster role %s. %s' % (project_owner_name, e))
@@ -192,42 +190,154 @@ def modify_pod_hook(spawner, pod):
     pod.spec.automount_service_account_token = True
     pod.spec.service_account_name = user_account_name
 
-    # Ensure that a service account exists corresponding to the user.
-    # Need to do this as it may have been cleaned up if the session had
-    # expired and user wasn't logged out in the browser.
+    resource_budget = os.environ.get('RESOURCE_BUDGET', 'default')
 
-    owner_uid = yield create_service_account(spawner, pod)
+    # Calculate fingerprints for what each provisioning step would create
+    # and compare them to those recorded against the project for the user
+    # when last provisioned. Steps whose fingerprint hasn't changed will
+    # be skipped.
+
+    fingerprints = {
+        'service-account': provisioning_fingerprint(
+                service_account_template.template),
+        'service-ports': provisioning_fingerprint(
+                service_template.template, route_template.template,
+                os.environ.get('EXPOSED_PORTS', ''), cluster_subdomain),
+        'project-namespace': provisioning_fingerprint(
+                namespace_template.template, project_owner.metadata.uid),
+        'project-setup': provisioning_fingerprint(
+                role_binding_template.template, 'admin', resource_budget,
+                resource_budget_mapping.get(resource_budget)),
+        'extra-resources': provisioning_fingerprint(extra_resources),
+    }
 
-    # If there are any exposed ports defined for the session, create
-    # a service object mapping to the pod for the ports, and create
-    # routes for each port.
+    fingerprints['account-ready'] = fingerprints['service-account']
 
-    yield expose_service_ports(spawner, pod, owner_uid)
+    provisioned = {}
 
-    # Create a project for just this user. Poll to make sure it is
-    # created before continue.
+    account_uid = None
+    project_uid = None
 
-    yield create_project_namespace(spawner, pod, project_name)
+    try:
+        project = yield api_call(namespace_resource.get, name=project_name)
 
-    # Now set up the project permissions and resource budget.
+    except ApiException as e:
+        if e.status != 404:
+            print('ERROR: Error querying project. %s' % e)
+            raise
 
-    resource_budget = os.environ.get('RESOURCE_BUDGET', 'default')
+    else:
+        annotations = project.metadata.annotations
+
+        if project.status.phase == 'Active' and annotations:
+            try:
+                provisioned = json.loads(
+                        annotations['spawner/fingerprints'] or '{}')
+
+            except ValueError:
+                pass
+
+            account_uid = annotations['spawner/account-uid']
+            project_uid = project.metadata.uid
+
+    # The service account may have been deleted since the project was
+    # last provisioned, so check it still exists and is the same one, in
+    # which case the stages which depend on it need to be run again. The
+    # informer's cache is used so this doesn't need a REST API request.
+
+    account = service_account_informer.get(user_account_name, namespace)
+
+    if account is None or account.metadata.uid != account_uid:
+        account_uid = None
+
+    if not account_uid:
+        provisioned.pop('service-account', None)
+        provisioned.pop('account-ready', None)
+        provisioned.pop('service-ports', None)
+
+    def stage(name, func, result=None):
+        def run(results):
+            if provisioned.get(name) == fingerprints[name]:
+                return result
+            return func(results)
+        return run
+
+    # The steps for provisioning the session are run as stages, with
+    # those which don't depend on each other being run concurrently.
+
+    stages = {
+        # Ensure that a service account exists corresponding to the user.
+        # This is skipped only if the one recorded against the project
+        # still exists, as it may have been cleaned up if the session had
+        # expired and user wasn't logged out in the browser.
+
+        'service-account': ((), stage('service-account',
+            lambda results: create_service_account(spawner, pod),
+            account_uid)),
 
-    project_uid = yield setup_project_namespace(spawner, pod, project_name,
-            'admin', resource_budget)
+        # If there are any exposed ports defined for the session, create
+        # a service object mapping to the pod for the ports, and create
+        # routes for each port.
 
-    # Before can continue, need to poll looking to see if the secret for
-    # the api token has been added to the service account. If don't do
-    # this then pod creation will fail immediately. To do this, must get
-    # the secrets from the service account and make sure they in turn
-    # exist.
+        'service-ports': (('service-account',), stage('service-ports',
+            lambda results: expose_service_ports(spawner, pod,
+                    results['service-account']))),
 
-    yield wait_on_service_account(user_account_name)
+        # Create a project for just this user.
+
+        'project-namespace': ((), stage('project-namespace',
+            lambda results: create_project_namespace(spawner, pod,
+                    project_name))),
+
+        # Now set up the project permissions and resource budget. This
+        # will wait to make sure the project is created before continuing.
+
+        'project-setup': (('project-namespace',), stage('project-setup',
+            lambda results: setup_project_namespace(spawner, pod,
+                    project_name, 'admin', resource_budget),
+            project_uid)),
+
+        # Before can continue, need to poll looking to see if the secret
+        # for the api token has been added to the service account. If
+        # don't do this then pod creation will fail immediately. To do
+        # this, must get the secrets from the service account and make
+        # sure they in turn exist.
+
+        'account-ready': (('service-account',), stage('account-ready',
+            lambda results: wait_on_service_account(user_account_name))),
+
+        # Create any extra resources in the project required for a
+        # workshop.
+
+        'extra-resources': (('project-setup', 'account-ready'),
+            stage('extra-resources',
+            lambda results: create_extra_resources(spawner, pod,
+                    project_name, results['project-setup'],
+                    user_account_name, short_name))),
+    }
+
+    results = yield run_stages(stages)
+
+    # Record the fingerprints against the project if anything changed.
+
+    if provisioned != fingerprints:
+        body = {
+            'metadata': {
+                'name': project_name,
+                'annotations': {
+                    'spawner/fingerprints': json.dumps(fingerprints,
+                            sort_keys=True),
+                    'spawner/account-uid': results['service-account']
+                }
+            }
+        }
 
-    # Create any extra resources in the project required for a workshop.
+        try:
+            yield api_call(namespace_resource.patch, body=body,
+                    content_type='application/merge-patch+json')
 
-    yield create_extra_resources(spawner, pod, project_name, project_uid,
-            user_account_name, short_name)
+        except Exception as e:
+            print('WARNING: Error recording project fingerprints. %s' % e)
 
     # Add environment variable for the project namespace for use in any
     # workshop content.
@@ -268,7 +378,13 @@ if idle_timeout and int(idle_timeout):
             'environment': dict(
                 ENV="/opt/app-root/etc/profile",
                 BASH_ENV="/opt/app-root/etc/profile",
-                PROMPT_COMMAND=". /opt/app-root/etc/profile"
+                PROMPT_COMMAND=". /opt/app-root/etc/profile",
+                APPLICATION_NAME=application_name,
+                KUBERNETES_SERVICE_HOST=kubernetes_service_host,
+                KUBERNETES_SERVICE_PORT=kubernetes_service_port,
+                IDLE_POLICY=os.environ.get('IDLE_POLICY', 'activity'),
+                IDLE_CPU_THRESHOLD=os.environ.get('IDLE_CPU_THRESHOLD', '10'),
+                CULLER_METRICS_PORT=os.environ.get('CULLER_METRICS_PORT', '0')
             ),
         }
     ])
@@ -0,0 +1,178 @@
+# This file provides a cache of which resource types supported by the
+# cluster are namespaced. It is loaded into the JupyterHub configuration
+# as well as the service which deletes projects. Walking all the API
+# groups to work this out is slow on clusters with many custom resource
+# definitions, so the result is saved to a file in the data directory
+# where it can be shared by both. The saved result is only used if it
+# was for the same version of the cluster, and once older than the time
+# to live, is refreshed in the background while the existing result
+# continues to be used. Only one refresh is done at a time. If an API
+# group can't be queried during a refresh, what was known about it from
+# the existing result is kept, and if the core API group can't be
+# queried, the refresh fails and the existing result is left alone.
+
+import json
+import os
+import threading
+import time
+
+discovery_cache_file = '/opt/app-root/data/discovery-cache.json'
+
+discovery_cache_ttl = float(os.environ.get('DISCOVERY_CACHE_TTL', '600'))
+
+class DiscoveryCache(object):
+
+    def __init__(self, api_client, server_version, path=discovery_cache_file,
+            ttl=discovery_cache_ttl):
+        self.api_client = api_client
+        self.server_version = server_version
+        self.path = path
+        self.ttl = ttl
+
+        self._resources = None
+        self._timestamp = 0.0
+
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refreshing = False
+
+    def _discover(self):
+        # Query the discovery endpoints directly, rather than through the
+        # dynamic client, as only the name of each resource type and
+        # whether it is namespaced is needed. This relies on the helper
+        # for records having been loaded.
+
+        resources = set()
+        failed = set()
+
+        group_versions = ['v1']
+
+        for group in raw_get(self.api_client, '/apis').get('groups') or []:
+            for version in group.get('versions') or []:
+                group_versions.append(version['groupVersion'])
+
+        for group_version in group_versions:
+            if group_version == 'v1':
+                path = '/api/v1'
+            else:
+                path = '/apis/%s' % group_version
+
+            try:
+                data = raw_get(self.api_client, path)
+
+            except Exception:
+                if group_version == 'v1':
+                    raise
+
+                failed.add(group_version)
+                continue
+
+            for resource in data.get('resources') or []:
+                # Names containing a slash are subresources.
+
+                if '/' in resource['name'] or not resource.get('namespaced'):
+                    continue
+
+                resources.add((group_version, resource['kind']))
+
+        previous = self._resources or set()
+
+        resources.update(item for item in previous if item[0] in failed)
+
+        return resources
+
+    def _load(self):
+        try:
+            with open(self.path) as fp:
+                data = json.load(fp)
+
+        except Exception:
+            return None
+
+        if data.get('version') != self.server_version:
+            return None
+
+        return (set(tuple(item) for item in data['resources']),
+                data['timestamp'])
+
+    def _save(self, resources, timestamp):
+        data = {
+            'version': self.server_version,
+            'timestamp': timestamp,
+            'resources': sorted(resources)
+        }
+
+        # Write to a temporary file and rename it so the other process
+        # never sees a partially written file.
+
+        temporary = '%s.%d' % (self.path, os.getpid())
+
+        try:
+            with open(temporary, 'w') as fp:
+                json.dump(data, fp)
+
+            os.replace(temporary, self.path)
+
+        except Exception as e:
+            print('WARNING: Cannot save discovery cache. %s' % e)
+
+    def _update(self, resources, timestamp):
+        with self._lock:
+            if timestamp > self._timestamp:
+                self._resources = resources
+                self._timestamp = timestamp
+
+    def refresh(self, missing_only=False):
+        with self._refresh_lock:
+            try:
+                # Another thread may have completed the first lookup
+                # while this one was waiting.
+
+                if missing_only and self._resources is not None:
+                    return
+
+                resources = self._discover()
+
+            except Exception as e:
+                print('ERROR: Failed to discover resource types. %s' % e)
+
+            else:
+                timestamp = time.time()
+
+                self._update(resources, timestamp)
+                self._save(resources, timestamp)
+
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        thread = threading.Thread(target=self.refresh)
+        thread.daemon = True
+        thread.start()
+
+    def get(self):
+        if self._resources is None or time.time() - self._timestamp > self.ttl:
+            # The other process may have refreshed the saved result, so
+            # check that before doing discovery ourselves.
+
+            loaded = self._load()
+
+            if loaded is not None:
+                self._update(*loaded)
+
+        if self._resources is None:
+            with self._lock:
+                self._refreshing = True
+
+            self.refresh(missing_only=True)
+
+        elif time.time() - self._timestamp > self.ttl:
+            self._refresh_in_background()
+
+        return self._resources or set()
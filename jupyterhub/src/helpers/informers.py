@@ -0,0 +1,276 @@
+# This file provides an in memory cache of resources of a specific type,
+# kept up to date by listing them once and then watching for changes.
+# It is loaded into the JupyterHub configuration as well as the service
+# which deletes projects, so that reads of objects which are looked at
+# over and over are served from memory rather than each being a request
+# against the REST API. An informer should be restricted using label or
+# field selectors to just the objects which are of interest.
+#
+# Where only the metadata of objects is needed, the informer can ask for
+# just that, which saves transferring and holding the full objects. The
+# REST API server will fall back to returning full objects if it doesn't
+# support this. The objects are then held as records, so the helper for
+# those must also be loaded.
+#
+# Objects can be looked up by namespace and name, or using an index. The
+# default indexes are by the user the object belongs to, the session it
+# was created for, and the UIDs of its owners. Listeners can be added to
+# be notified of changes, being called with the type of event and the
+# object, from the thread the informer runs in.
+#
+# Requests made by an informer are given the priority for watches, so
+# the helper for rate limiting requests must also be loaded.
+
+import threading
+import time
+
+from kubernetes.client.rest import ApiException
+
+informer_watch_timeout = 300
+
+informer_retry_delay = 5.0
+
+def index_by_user(obj):
+    labels = obj.metadata.labels
+    user = labels and labels.get('user')
+    return user and [user] or []
+
+def index_by_session(obj):
+    annotations = obj.metadata.annotations
+    session = annotations and annotations.get('spawner/session')
+    return session and [session] or []
+
+def index_by_owner(obj):
+    return [reference['uid'] for reference in
+            obj.metadata.ownerReferences or []]
+
+default_indexers = {
+    'user': index_by_user,
+    'session': index_by_session,
+    'owner': index_by_owner
+}
+
+class Informer(object):
+
+    def __init__(self, api_client, resource, namespace=None,
+            label_selector=None, field_selector=None, indexers=None,
+            metadata_only=False):
+        self.api_client = api_client
+        self.resource = resource
+        self.namespace = namespace
+        self.label_selector = label_selector
+        self.field_selector = field_selector
+        self.metadata_only = metadata_only
+
+        if indexers is None:
+            indexers = default_indexers
+
+        self.indexers = dict(indexers)
+
+        self._objects = {}
+        self._indexes = dict((name, {}) for name in self.indexers)
+
+        self._condition = threading.Condition()
+        self._listeners = []
+
+        self._synced = False
+        self._thread = None
+
+    def _key(self, obj):
+        return (obj.metadata.namespace, obj.metadata.name)
+
+    def _unindex(self, key, obj):
+        for name, func in self.indexers.items():
+            index = self._indexes[name]
+            for value in func(obj):
+                keys = index.get(value)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del index[value]
+
+    def _index(self, key, obj):
+        for name, func in self.indexers.items():
+            index = self._indexes[name]
+            for value in func(obj):
+                index.setdefault(value, set()).add(key)
+
+    def _notify(self, events):
+        for event_type, obj in events:
+            for listener in list(self._listeners):
+                try:
+                    listener(event_type, obj)
+                except Exception as e:
+                    print('ERROR: Informer listener for %s failed. %s' % (
+                            self.resource.kind, e))
+
+    def _replace(self, items):
+        # Called with the results of a list, so need to work out what
+        # changed while not watching so listeners can be told.
+
+        events = []
+
+        with self._condition:
+            objects = {}
+
+            for obj in items:
+                objects[self._key(obj)] = obj
+
+            for key, obj in list(self._objects.items()):
+                if key not in objects:
+                    self._unindex(key, obj)
+                    del self._objects[key]
+                    events.append(('DELETED', obj))
+
+            for key, obj in objects.items():
+                previous = self._objects.get(key)
+
+                if previous is not None:
+                    if (previous.metadata.resourceVersion ==
+                            obj.metadata.resourceVersion):
+                        continue
+                    self._unindex(key, previous)
+                    events.append(('MODIFIED', obj))
+                else:
+                    events.append(('ADDED', obj))
+
+                self._objects[key] = obj
+                self._index(key, obj)
+
+            self._synced = True
+            self._condition.notify_all()
+
+        self._notify(events)
+
+    def _update(self, event_type, obj):
+        key = self._key(obj)
+
+        with self._condition:
+            previous = self._objects.pop(key, None)
+
+            if previous is not None:
+                self._unindex(key, previous)
+
+            if event_type != 'DELETED':
+                self._objects[key] = obj
+                self._index(key, obj)
+
+            self._condition.notify_all()
+
+        self._notify([(event_type, obj)])
+
+    def _list(self):
+        if self.metadata_only:
+            return list_metadata(self.api_client, self.resource,
+                    namespace=self.namespace,
+                    label_selector=self.label_selector,
+                    field_selector=self.field_selector)
+
+        objects = self.resource.get(namespace=self.namespace,
+                label_selector=self.label_selector,
+                field_selector=self.field_selector)
+
+        return objects.items, objects.metadata.resourceVersion
+
+    def _watch(self, resource_version):
+        if self.metadata_only:
+            return watch_metadata(self.api_client, self.resource,
+                    namespace=self.namespace,
+                    label_selector=self.label_selector,
+                    field_selector=self.field_selector,
+                    resource_version=resource_version,
+                    timeout=informer_watch_timeout)
+
+        return self.api_client.watch(self.resource,
+                namespace=self.namespace,
+                label_selector=self.label_selector,
+                field_selector=self.field_selector,
+                resource_version=resource_version,
+                timeout=informer_watch_timeout)
+
+    def _list_and_watch(self):
+        items, resource_version = self._list()
+
+        self._replace(items)
+
+        while True:
+            for event in self._watch(resource_version):
+
+                # An error will usually mean that the resource version
+                # being watched from has expired, so list again.
+
+                if event['type'] == 'ERROR':
+                    return
+
+                if event['type'] in ('ADDED', 'MODIFIED', 'DELETED'):
+                    obj = event['object']
+                    resource_version = obj.metadata.resourceVersion
+                    self._update(event['type'], obj)
+
+    def _run(self):
+        with request_priority('watch'):
+            self._run_forever()
+
+    def _run_forever(self):
+        while True:
+            try:
+                self._list_and_watch()
+                continue
+
+            except ApiException as e:
+                if e.status != 410:
+                    print('ERROR: Informer for %s failed. %s' % (
+                            self.resource.kind, e))
+
+            except Exception as e:
+                print('ERROR: Informer for %s failed. %s' % (
+                        self.resource.kind, e))
+
+            time.sleep(informer_retry_delay)
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None:
+                return self
+
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+        return self
+
+    @property
+    def synced(self):
+        return self._synced
+
+    def wait_for_sync(self, timeout=None):
+        with self._condition:
+            return self._condition.wait_for(lambda: self._synced, timeout)
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def get(self, name, namespace=None):
+        with self._condition:
+            return self._objects.get((namespace, name))
+
+    def list(self, index=None, value=None):
+        with self._condition:
+            if index is None:
+                return list(self._objects.values())
+
+            keys = self._indexes[index].get(value, ())
+
+            return [self._objects[key] for key in keys]
+
+    def wait_for(self, name, namespace=None, condition=None, timeout=10.0):
+        def check():
+            obj = self._objects.get((namespace, name))
+            if obj is not None and (condition is None or condition(obj)):
+                return obj
+
+        with self._condition:
+            return self._condition.wait_for(check, timeout)
@@ -0,0 +1,199 @@
+# This file provides a token bucket for limiting the rate at which
+# requests are made against the REST API, along with a helper for
+# retrying requests which the REST API server rejected because it was
+# overloaded or failed. It is loaded into the JupyterHub configuration
+# as well as the service which deletes projects.
+#
+# A variant of the token bucket which serves requests by priority can be
+# used to gate all requests made through a REST API client. The priority
+# of requests is set for the thread making them, falling back to the
+# default priority for the process, with requests made on the critical
+# path for starting a session served first, then those for watching
+# resources, and finally those for garbage collection. Each process has
+# its own bucket, so priorities only order requests made from within the
+# one process, and the limits of each process add up to the total rate
+# against the REST API server.
+
+import functools
+import threading
+import time
+
+from kubernetes.client.rest import ApiException
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst=None):
+        # A rate of zero or less means requests aren't limited.
+
+        self.rate = float(rate)
+        self.burst = float(burst or max(1.0, self.rate))
+
+        self._tokens = self.burst
+        self._timestamp = time.monotonic()
+
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate, burst=None):
+        with self._lock:
+            self._refill()
+
+            self.rate = float(rate)
+            self.burst = float(burst or max(1.0, self.rate))
+
+            self._tokens = min(self._tokens, self.burst)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens +
+                (now - self._timestamp) * self.rate)
+        self._timestamp = now
+
+    def acquire(self, tokens=1.0):
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self._lock:
+                self._refill()
+
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+
+                delay = (tokens - self._tokens) / self.rate
+
+            time.sleep(delay)
+
+request_priorities = ('spawn', 'watch', 'gc')
+
+default_request_priority = 'spawn'
+
+_request_context = threading.local()
+
+def current_request_priority():
+    return getattr(_request_context, 'priority', default_request_priority)
+
+class request_priority(object):
+
+    def __init__(self, priority):
+        assert priority in request_priorities
+        self.priority = priority
+
+    def __enter__(self):
+        self._previous = current_request_priority()
+        _request_context.priority = self.priority
+
+    def __exit__(self, *exc_info):
+        _request_context.priority = self._previous
+
+def run_with_priority(priority, func, *args, **kwargs):
+    with request_priority(priority):
+        return func(*args, **kwargs)
+
+class PriorityTokenBucket(TokenBucket):
+
+    def __init__(self, rate, burst=None):
+        super().__init__(rate, burst)
+
+        self._condition = threading.Condition(self._lock)
+        self._waiting = dict((priority, 0) for priority in request_priorities)
+
+    def _required(self, level, tokens):
+        # Lower priority requests leave part of the burst unused, so that
+        # higher priority requests which come along later don't find the
+        # bucket empty.
+
+        reserve = self.burst * level / len(request_priorities)
+
+        return tokens + min(reserve, self.burst - tokens)
+
+    def _blocked(self, level):
+        # Requests can't proceed while any of a higher priority are
+        # waiting on tokens.
+
+        return any(self._waiting[priority] for priority in
+                request_priorities[:level])
+
+    def acquire(self, tokens=1.0, priority=None):
+        if self.rate <= 0:
+            return
+
+        if priority is None:
+            priority = current_request_priority()
+
+        level = request_priorities.index(priority)
+
+        required = self._required(level, tokens)
+
+        with self._condition:
+            self._waiting[priority] += 1
+
+            try:
+                while True:
+                    self._refill()
+
+                    if not self._blocked(level) and self._tokens >= required:
+                        self._tokens -= tokens
+                        return
+
+                    self._condition.wait(max(required - self._tokens,
+                            tokens) / self.rate)
+
+            finally:
+                self._waiting[priority] -= 1
+                self._condition.notify_all()
+
+def gate_api_requests(api_client, limiter):
+    # All requests made using the dynamic client, or the records helper,
+    # go through call_api() of the underlying REST API client.
+
+    client = api_client.client
+
+    call_api = client.call_api
+
+    @functools.wraps(call_api)
+    def _gated_call_api(*args, **kwargs):
+        limiter.acquire()
+        return call_api(*args, **kwargs)
+
+    client.call_api = _gated_call_api
+
+retry_attempts = 5
+
+retry_delay = 0.5
+
+retry_max_delay = 30.0
+
+def retry_request(limiter, func, *args, **kwargs):
+    delay = retry_delay
+
+    for attempt in range(retry_attempts):
+        if limiter is not None:
+            limiter.acquire()
+
+        try:
+            return func(*args, **kwargs)
+
+        except ApiException as e:
+            if e.status != 429 and e.status < 500:
+                raise
+
+            if attempt == retry_attempts - 1:
+                raise
+
+            # Respect any delay the REST API server asked for, otherwise
+            # back off exponentially.
+
+            retry_after = e.headers and e.headers.get('Retry-After')
+
+            try:
+                wait = float(retry_after)
+            except (TypeError, ValueError):
+                wait = delay
+
+            print('WARNING: request failed with status %s, retrying in %.1f '
+                    'seconds' % (e.status, wait))
+
+            time.sleep(min(wait, retry_max_delay))
+
+            delay = min(2 * delay, retry_max_delay)
@@ -0,0 +1,92 @@
+# This file provides a fast path for list and watch requests where only
+# the metadata of objects is needed. The dynamic client wraps every
+# object in a response, including every nested field, in its own Python
+# objects, which for large lists costs a lot of CPU and memory. Here the
+# raw response is decoded and each object turned into a record holding
+# just its type and metadata. It is loaded into the JupyterHub
+# configuration as well as the service which deletes projects.
+#
+# Labels and annotations of a record are plain dictionaries, or None if
+# the object doesn't have any, so use get() to look up values.
+
+import json
+
+json_loads = json.loads
+
+from kubernetes.watch.watch import iter_resp_lines
+
+partial_object_metadata_list = ('application/json;as=PartialObjectMetadataList;'
+        'g=meta.k8s.io;v=v1,application/json')
+
+partial_object_metadata = ('application/json;as=PartialObjectMetadata;'
+        'g=meta.k8s.io;v=v1,application/json')
+
+class ObjectMetadata(object):
+
+    __slots__ = ('name', 'namespace', 'uid', 'resourceVersion', 'labels',
+            'annotations', 'ownerReferences', 'deletionTimestamp',
+            'finalizers')
+
+    def __init__(self, metadata):
+        self.name = metadata.get('name')
+        self.namespace = metadata.get('namespace')
+        self.uid = metadata.get('uid')
+        self.resourceVersion = metadata.get('resourceVersion')
+        self.labels = metadata.get('labels')
+        self.annotations = metadata.get('annotations')
+        self.ownerReferences = metadata.get('ownerReferences')
+        self.deletionTimestamp = metadata.get('deletionTimestamp')
+        self.finalizers = metadata.get('finalizers')
+
+class ObjectRecord(object):
+
+    __slots__ = ('apiVersion', 'kind', 'metadata')
+
+    def __init__(self, item):
+        self.apiVersion = item.get('apiVersion')
+        self.kind = item.get('kind')
+        self.metadata = ObjectMetadata(item.get('metadata') or {})
+
+def raw_request(api_client, path, accept='application/json', **params):
+    return api_client.client.call_api(path, 'GET', path_params={},
+            query_params=[(key, value) for key, value in params.items()
+                    if value is not None],
+            header_params={'Accept': accept}, auth_settings=['BearerToken'],
+            _preload_content=False, _return_http_data_only=True)
+
+def raw_get(api_client, path, accept='application/json', **params):
+    response = raw_request(api_client, path, accept, **params)
+
+    try:
+        return json_loads(response.data)
+
+    finally:
+        response.release_conn()
+
+def list_metadata(api_client, resource, namespace=None, label_selector=None,
+        field_selector=None):
+
+    data = raw_get(api_client, resource.path(namespace=namespace),
+            partial_object_metadata_list, labelSelector=label_selector,
+            fieldSelector=field_selector)
+
+    return ([ObjectRecord(item) for item in data.get('items') or []],
+            data['metadata'].get('resourceVersion'))
+
+def watch_metadata(api_client, resource, namespace=None, label_selector=None,
+        field_selector=None, resource_version=None, timeout=None):
+
+    response = raw_request(api_client, resource.path(namespace=namespace),
+            partial_object_metadata, labelSelector=label_selector,
+            fieldSelector=field_selector, resourceVersion=resource_version,
+            timeoutSeconds=timeout, watch='true')
+
+    try:
+        for line in iter_resp_lines(response):
+            event = json_loads(line)
+            event['object'] = ObjectRecord(event['object'])
+            yield event
+
+    finally:
+        response.close()
+        response.release_conn()
@@ -0,0 +1,60 @@
+# This file provides support for templates used to generate definitions
+# of resources. It is loaded into the JupyterHub configuration, as well
+# as the benchmark scripts, and so should avoid depending on anything
+# else which is defined in the configuration.
+#
+# A template is parsed once into a tree of objects when it is loaded.
+# Any string in the tree, whether a key or a value, which contains a
+# placeholder is marked as a slot. Rendering the template for a user
+# then only requires copying the tree and filling in the slots, rather
+# than substituting values into the text and parsing it every time.
+
+import json
+import string
+
+def _compile_template_node(node):
+    if isinstance(node, dict):
+        entries = [(_compile_template_node(key), _compile_template_node(value))
+                for key, value in node.items()]
+
+        return lambda values: dict((key(values), value(values))
+                for key, value in entries)
+
+    if isinstance(node, list):
+        items = [_compile_template_node(item) for item in node]
+
+        return lambda values: [item(values) for item in items]
+
+    if isinstance(node, str) and '$' in node:
+        template = string.Template(node)
+
+        return lambda values: template.safe_substitute(values)
+
+    return lambda values: node
+
+class ResourceTemplate(object):
+
+    def __init__(self, template, loader=json.loads):
+        self.template = template
+        self.loader = loader
+
+        # If the template can't be parsed until values have been filled
+        # in, for example where a placeholder isn't within a string in a
+        # JSON template, fall back to substituting into the text.
+
+        try:
+            self._render = _compile_template_node(loader(template))
+
+        except Exception:
+            self._render = None
+
+    @property
+    def compiled(self):
+        return self._render is not None
+
+    def render(self, **values):
+        if self._render is None:
+            text = string.Template(self.template).safe_substitute(values)
+            return self.loader(text)
+
+        return self._render(values)
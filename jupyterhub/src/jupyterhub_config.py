@@ -7,13 +7,24 @@ import os
 import json
 import string
 import yaml
-import threading
 import time
+import functools
+import math
+import copy
+import hashlib
+import collections
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 import requests
 import wrapt
 
 from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.locks import Lock
 
 from kubernetes.client.rest import ApiException
 from kubernetes.client.configuration import Configuration
@@ -83,15 +94,67 @@ kubernetes_server_url = 'https://%s:%s' % (kubernetes_service_host,
 
 kubernetes_server_version_url = '%s/version' % kubernetes_server_url
 
-with requests.Session() as session:
-    response = session.get(kubernetes_server_version_url, verify=False)
-    kubernetes_server_info = json.loads(response.content.decode('UTF-8'))
+# The lookups against the REST API needed to work out the configuration
+# don't depend on each other, so rather than making them one after the
+# other, they are started up front and run concurrently in a pool of
+# threads. Each has its own timeout so a slow API server fails startup
+# with a clear message rather than hanging, and how long each took is
+# reported once the configuration has been loaded. Requests made by the
+# lookups, and those made directly while loading the configuration, are
+# also given the timeout, as a hung request would otherwise still hold up
+# the process, including from exiting. Lookups mustn't wait on
+# the results of other lookups from within the pool, instead they should
+# be started once the results they need are available.
 
-image_registry = 'image-registry.openshift-image-registry.svc:5000'
+startup_time = time.time()
 
-if kubernetes_server_info['major'] == '1':
-    if kubernetes_server_info['minor'] in ('10', '10+', '11', '11+'):
-        image_registry = 'docker-registry.default.svc:5000'
+startup_lookup_timeout = float(os.environ.get('STARTUP_LOOKUP_TIMEOUT', '30'))
+
+startup_executor = ThreadPoolExecutor(max_workers=8)
+
+startup_lookups = {}
+startup_timings = {}
+
+startup_context = threading.local()
+
+startup_context.timeout = startup_lookup_timeout
+
+def startup_lookup(name, func, *args, **kwargs):
+    def run():
+        start = time.time()
+        startup_context.timeout = startup_lookup_timeout
+        try:
+            return func(*args, **kwargs)
+        finally:
+            startup_timings[name] = time.time() - start
+
+    startup_lookups[name] = startup_executor.submit(run)
+
+def startup_result(name):
+    try:
+        return startup_lookups[name].result(timeout=startup_lookup_timeout)
+
+    except FutureTimeoutError:
+        raise RuntimeError('Timeout after %.0f seconds on startup lookup %r.'
+                % (startup_lookup_timeout, name))
+
+def report_startup_timings():
+    startup_context.timeout = None
+
+    for name, duration in sorted(startup_timings.items(),
+            key=lambda item: item[1], reverse=True):
+        print('INFO: Startup lookup %r took %.3f seconds.' % (name, duration))
+
+    print('INFO: Configuration loaded in %.3f seconds.' % (
+            time.time() - startup_time))
+
+def get_kubernetes_server_info():
+    with requests.Session() as session:
+        response = session.get(kubernetes_server_version_url, verify=False,
+                timeout=startup_lookup_timeout)
+        return json.loads(response.content.decode('UTF-8'))
+
+startup_lookup('server-version', get_kubernetes_server_info)
 
 # Initialise the client for the REST API used doing configuration.
 #
@@ -106,85 +169,281 @@ import urllib3
 urllib3.disable_warnings()
 instance = Configuration()
 instance.verify_ssl = False
+
+# The REST API client is blocking, so calls made while a session is
+# being spawned are run in a bounded pool of threads, rather than in the
+# JupyterHub event loop. Make sure the connection pool is big enough that
+# the threads, including those used for watches, don't end up waiting on
+# each other for a connection.
+
+api_client_threads = int(os.environ.get('API_CLIENT_THREADS', '10'))
+
+instance.connection_pool_maxsize = max(instance.connection_pool_maxsize,
+        2*api_client_threads)
+
 Configuration.set_default(instance)
 
-api_client = DynamicClient(ApiClient())
+def _startup_call_api(call_api):
+    @functools.wraps(call_api)
+    def _call_api(*args, **kwargs):
+        timeout = getattr(startup_context, 'timeout', None)
+        if timeout and not kwargs.get('_request_timeout'):
+            kwargs['_request_timeout'] = (timeout, timeout)
+        return call_api(*args, **kwargs)
+    return _call_api
 
-try:
-    image_stream_resource = api_client.resources.get(
-         api_version='image.openshift.io/v1', kind='ImageStream')
-except ResourceNotFoundError:
-    image_stream_resource = None
+rest_api_client = ApiClient()
+rest_api_client.call_api = _startup_call_api(rest_api_client.call_api)
 
-try:
-    route_resource = api_client.resources.get(
-         api_version='route.openshift.io/v1', kind='Route')
-except ResourceNotFoundError:
-    route_resource = None
+api_client = DynamicClient(rest_api_client)
 
-ingress_resource = api_client.resources.get(
-     api_version='extensions/v1beta1', kind='Ingress')
+api_executor = ThreadPoolExecutor(max_workers=api_client_threads)
 
-# Create a background thread to dynamically calculate back link to the
-# Homeroom workshop picker if no explicit link is provided, but group is.
+def api_call(func, *args, priority=None, **kwargs):
+    if priority is not None:
+        func, args = run_with_priority, (priority, func) + args
 
-def watch_for_homeroom():
-    global homeroom_link
+    return IOLoop.current().run_in_executor(api_executor,
+            functools.partial(func, *args, **kwargs))
+
+# Requests made through the REST API client can be limited to a maximum
+# rate, with requests needed to start a session being served ahead of
+# those from watches, and those from background tasks going last. This
+# is disabled unless a rate is provided. The priorities only apply to
+# requests made by JupyterHub itself. Where a separate service is also
+# making requests, such as the one which deletes projects, it is given
+# its own budget taken out of this rate.
+
+helpers_root = '/opt/app-root/src/helpers'
+
+with open('%s/ratelimit.py' % helpers_root) as fp:
+    exec(compile(fp.read(), '%s/ratelimit.py' % helpers_root, 'exec'), globals())
+
+api_request_rate = float(os.environ.get('API_REQUEST_RATE', '0'))
+api_request_burst = float(os.environ.get('API_REQUEST_BURST', '0'))
+
+api_request_limiter = PriorityTokenBucket(api_request_rate, api_request_burst)
+
+gate_api_requests(api_client, api_request_limiter)
+
+def background_api_call(func, *args, **kwargs):
+    return api_call(func, *args, priority='gc', **kwargs)
+
+# Provisioning done for a session is at the priority of the spawner, with
+# stand ins for spawners used when provisioning in the background able to
+# set a lower priority.
+
+def spawner_priority(spawner):
+    return getattr(spawner, 'api_priority', None)
+
+# Waiting on a resource to exist, or reach some state, is done using the
+# watch API rather than by polling. Waits can be long running, so they
+# are run in their own pool of threads so as not to hold up other calls.
+
+watch_executor = ThreadPoolExecutor(max_workers=api_client_threads)
+
+def _wait_for_resource(resource, name, namespace, condition, timeout):
+    deadline = time.time() + timeout
+
+    field_selector = 'metadata.name=%s' % name
 
     while True:
-        if route_resource is not None:
-            try:
-                route = route_resource.get(namespace=namespace, name=homeroom_name)
+        # List first to get the current state, along with the resource
+        # version to start watching from for any subsequent changes.
 
-                scheme = 'http'
+        objects = resource.get(namespace=namespace,
+                field_selector=field_selector)
 
-                if route.metadata.annotations:
-                    if route.metadata.annotations['homeroom/index'] == homeroom_name:
-                        if route.tls and route.tls.termination:
-                            scheme = 'https'
+        for obj in objects.items:
+            if condition is None or condition(obj):
+                return obj
 
-                        link = '%s://%s' % (scheme, route.spec.host)
+        resource_version = objects.metadata.resourceVersion
 
-                        if link != homeroom_link:
-                            print('INFO: Homeroom link set to %s.' % link)
-                            homeroom_link = link
+        remaining = deadline - time.time()
 
-            except ApiException as e:
-                if e.status != 404:
-                    print('ERROR: Error looking up homeroom route. %s' % e)
+        if remaining <= 0:
+            return None
 
-            except Exception as e:
-                print('ERROR: Error looking up homeroom route. %s' % e)
+        for event in api_client.watch(resource, namespace=namespace,
+                field_selector=field_selector,
+                resource_version=resource_version,
+                timeout=max(1, int(math.ceil(remaining)))):
 
-        try:
-            ingress = ingress_resource.get(namespace=namespace, name=homeroom_name)
+            # An error will usually mean that the resource version we
+            # are watching from has expired, so list again.
 
-            scheme = 'http'
+            if event['type'] == 'ERROR':
+                break
 
-            if ingress.metadata.annotations:
-                if ingress.metadata.annotations['homeroom/index'] == homeroom_name:
-                    if ingress.tls:
-                        scheme = 'https'
+            if event['type'] in ('ADDED', 'MODIFIED'):
+                obj = event['object']
+                if condition is None or condition(obj):
+                    return obj
 
-                    link = '%s://%s' % (scheme, ingress.spec.rules[0].host)
+            if time.time() >= deadline:
+                return None
 
-                    if link != homeroom_link:
-                        print('INFO: Homeroom link set to %s.' % link)
-                        homeroom_link = link
+        if time.time() >= deadline:
+            return None
 
-        except ApiException as e:
-            if e.status != 404:
-                print('ERROR: Error looking up homeroom ingress. %s' % e)
+def wait_for_resource(resource, name, namespace=None, condition=None,
+        timeout=10.0, priority=None):
+    func, args = _wait_for_resource, (resource, name, namespace, condition,
+            timeout)
 
-        except Exception as e:
-            print('ERROR: Error looking up homeroom ingress. %s' % e)
+    if priority is not None:
+        func, args = run_with_priority, (priority, func) + args
 
-        time.sleep(15)
+    return IOLoop.current().run_in_executor(watch_executor,
+            functools.partial(func, *args))
+
+# Start the remaining lookups. Route and image stream resource types only
+# exist on OpenShift, so it isn't an error if they can't be found.
+
+def lookup_resource_type(api_version, kind, optional=False):
+    try:
+        return api_client.resources.get(api_version=api_version, kind=kind)
+    except ResourceNotFoundError:
+        if not optional:
+            raise
+
+startup_lookup('image-stream-resource', lookup_resource_type,
+        'image.openshift.io/v1', 'ImageStream', optional=True)
+
+startup_lookup('route-resource', lookup_resource_type,
+        'route.openshift.io/v1', 'Route', optional=True)
+
+startup_lookup('ingress-resource', lookup_resource_type,
+        'extensions/v1beta1', 'Ingress')
+
+# Work out hostname for the exposed route of the JupyterHub server. This
+# is tricky as we need to use the REST API to query it. This is used
+# when needing to do OAuth. The lookup needs the route and ingress
+# resource types, so is started once those lookups have completed.
+
+public_hostname = os.environ.get('PUBLIC_HOSTNAME')
+public_protocol = os.environ.get('PUBLIC_PROTOCOL')
+
+route_name = '%s-spawner' % application_name
+
+def lookup_public_hostname(route_resource, ingress_resource):
+    if route_resource is not None:
+        routes = route_resource.get(namespace=namespace)
+
+        for route in routes.items:
+            if route.metadata.name == route_name:
+                return (route.spec.tls and 'https' or 'http', route.spec.host)
+
+    ingresses = ingress_resource.get(namespace=namespace)
+
+    for ingresses in ingresses.items:
+        if ingresses.metadata.name == route_name:
+            return (ingresses.spec.tls and 'https' or 'http',
+                    ingresses.spec.rules[0].host)
+
+    raise RuntimeError('Cannot calculate external host name for the spawner.')
+
+# The cluster role which is made the owner of project namespaces is only
+# needed by the configuration types which create them.
+
+project_owner_name = '%s-spawner-extra' % application_name
+
+if configuration_type in ('learning-portal', 'user-workspace'):
+    startup_lookup('project-owner', lambda: api_client.resources.get(
+            api_version='rbac.authorization.k8s.io/v1',
+            kind='ClusterRole').get(project_owner_name))
+
+# Now wait on the lookups which are needed straight away.
+
+kubernetes_server_info = startup_result('server-version')
+
+image_registry = 'image-registry.openshift-image-registry.svc:5000'
+
+if kubernetes_server_info['major'] == '1':
+    if kubernetes_server_info['minor'] in ('10', '10+', '11', '11+'):
+        image_registry = 'docker-registry.default.svc:5000'
+
+image_stream_resource = startup_result('image-stream-resource')
+route_resource = startup_result('route-resource')
+ingress_resource = startup_result('ingress-resource')
+
+if not public_hostname:
+    startup_lookup('public-hostname', lookup_public_hostname,
+            route_resource, ingress_resource)
+
+# Objects which are read over and over are cached in memory by informers
+# which list them once and then watch for changes. Load the helpers which
+# implement the informers and the records they can hold.
+
+with open('%s/records.py' % helpers_root) as fp:
+    exec(compile(fp.read(), '%s/records.py' % helpers_root, 'exec'), globals())
+
+with open('%s/informers.py' % helpers_root) as fp:
+    exec(compile(fp.read(), '%s/informers.py' % helpers_root, 'exec'), globals())
+
+# Dynamically calculate back link to the Homeroom workshop picker if no
+# explicit link is provided, but group is. Informers watch just the route
+# and ingress with that name, with the link being updated as soon as a
+# change is seen, rather than polling for them.
+
+def set_homeroom_link(link):
+    global homeroom_link
+
+    if link != homeroom_link:
+        print('INFO: Homeroom link set to %s.' % link)
+        homeroom_link = link
+
+def homeroom_route_changed(event_type, route):
+    if event_type == 'DELETED':
+        return
+
+    try:
+        scheme = 'http'
+
+        if route.metadata.annotations:
+            if route.metadata.annotations['homeroom/index'] == homeroom_name:
+                if route.spec.tls and route.spec.tls.termination:
+                    scheme = 'https'
+
+                set_homeroom_link('%s://%s' % (scheme, route.spec.host))
+
+    except Exception as e:
+        print('ERROR: Error looking up homeroom route. %s' % e)
+
+def homeroom_ingress_changed(event_type, ingress):
+    if event_type == 'DELETED':
+        return
+
+    try:
+        scheme = 'http'
+
+        if ingress.metadata.annotations:
+            if ingress.metadata.annotations['homeroom/index'] == homeroom_name:
+                if ingress.spec.tls:
+                    scheme = 'https'
+
+                set_homeroom_link('%s://%s' % (scheme,
+                        ingress.spec.rules[0].host))
+
+    except Exception as e:
+        print('ERROR: Error looking up homeroom ingress. %s' % e)
 
 if not homeroom_link and homeroom_name:
-    thread = threading.Thread(target=watch_for_homeroom)
-    thread.daemon = True
-    thread.start()
+    if route_resource is not None:
+        homeroom_route_informer = Informer(api_client, route_resource,
+                namespace=namespace, indexers={},
+                field_selector='metadata.name=%s' % homeroom_name)
+
+        homeroom_route_informer.add_listener(homeroom_route_changed)
+        homeroom_route_informer.start()
+
+    homeroom_ingress_informer = Informer(api_client, ingress_resource,
+            namespace=namespace, indexers={},
+            field_selector='metadata.name=%s' % homeroom_name)
+
+    homeroom_ingress_informer.add_listener(homeroom_ingress_changed)
+    homeroom_ingress_informer.start()
 
 # Workaround bug in minishift where a service cannot be contacted from a
 # pod which backs the service. For further details see the minishift issue
@@ -400,40 +659,18 @@ def resolve_image_name(name):
 
     return name
 
-c.KubeSpawner.image = resolve_image_name(workshop_image)
+startup_lookup('workshop-image', resolve_image_name, workshop_image)
 
-# Work out hostname for the exposed route of the JupyterHub server. This
-# is tricky as we need to use the REST API to query it. This is used
-# when needing to do OAuth.
-
-public_hostname = os.environ.get('PUBLIC_HOSTNAME')
-public_protocol = os.environ.get('PUBLIC_PROTOCOL')
+c.KubeSpawner.image = startup_result('workshop-image')
 
-route_name = '%s-spawner' % application_name
+# Pick up the hostname for the exposed route of the JupyterHub server
+# if it had to be looked up.
 
 if not public_hostname:
-    if route_resource is not None:
-        routes = route_resource.get(namespace=namespace)
-
-        for route in routes.items:
-            if route.metadata.name == route_name:
-                if not public_protocol:
-                    public_protocol = route.spec.tls and 'https' or 'http'
-                public_hostname = route.spec.host
-                break
+    protocol, public_hostname = startup_result('public-hostname')
 
-    if not public_hostname:
-        ingresses = ingress_resource.get(namespace=namespace)
-
-        for ingresses in ingresses.items:
-            if ingresses.metadata.name == route_name:
-                if not public_protocol:
-                    public_protocol = ingresses.spec.tls and 'https' or 'http'
-                public_hostname = ingresses.spec.rules[0].host
-                break
-
-        if not public_hostname:
-            raise RuntimeError('Cannot calculate external host name for the spawner.')
+    if not public_protocol:
+        public_protocol = protocol
 
 c.Spawner.environment['JUPYTERHUB_ROUTE'] = '%s://%s' % (public_protocol, public_hostname)
 
@@ -486,7 +723,23 @@ resource_quota_resource = api_client.resources.get(
 service_resource = api_client.resources.get(
      api_version='v1', kind='Service')
 
-namespace_template = string.Template("""
+pod_resource = api_client.resources.get(
+     api_version='v1', kind='Pod')
+
+# Service accounts created for sessions are cached by an informer, so
+# that waiting on them to be ready doesn't need repeated requests.
+
+service_account_informer = Informer(api_client, service_account_resource,
+        namespace=namespace,
+        label_selector='app=%s' % application_name).start()
+
+# Templates for resources are parsed when loaded rather than each time a
+# resource is created. Load the helper for handling the templates.
+
+with open('%s/templates.py' % helpers_root) as fp:
+    exec(compile(fp.read(), '%s/templates.py' % helpers_root, 'exec'), globals())
+
+namespace_template = ResourceTemplate("""
 {
     "kind": "Namespace",
     "apiVersion": "v1",
@@ -519,7 +772,7 @@ namespace_template = string.Template("""
 }
 """)
 
-service_account_template = string.Template("""
+service_account_template = ResourceTemplate("""
 {
     "kind": "ServiceAccount",
     "apiVersion": "v1",
@@ -535,7 +788,7 @@ service_account_template = string.Template("""
 }
 """)
 
-role_binding_template = string.Template("""
+role_binding_template = ResourceTemplate("""
 {
     "kind": "RoleBinding",
     "apiVersion": "rbac.authorization.k8s.io/v1",
@@ -1232,7 +1485,7 @@ resource_budget_mapping = {
     }
 }
 
-service_template = string.Template("""
+service_template = ResourceTemplate("""
 {
     "kind": "Service",
     "apiVersion": "v1",
@@ -1267,7 +1520,7 @@ service_template = string.Template("""
 }
 """)
 
-route_template = string.Template("""
+route_template = ResourceTemplate("""
 {
     "apiVersion": "route.openshift.io/v1",
     "kind": "Route",
@@ -1308,6 +1561,7 @@ route_template = string.Template("""
 @gen.coroutine
 def create_service_account(spawner, pod):
     short_name = spawner.user.name
+    priority = spawner_priority(spawner)
     user_account_name = '%s-%s' % (application_name, short_name)
 
     owner_uid = None
@@ -1316,14 +1570,14 @@ def create_service_account(spawner, pod):
 
     while True:
         try:
-            text = service_account_template.safe_substitute(
+            body = service_account_template.render(
                     configuration=configuration_type, namespace=namespace,
                     name=user_account_name, application_name=application_name,
                     username=short_name)
-            body = json.loads(text)
 
-            service_account_object = service_account_resource.create(
-                    namespace=namespace, body=body)
+            service_account_object = yield api_call(
+                    service_account_resource.create,
+                    namespace=namespace, body=body, priority=priority)
 
             owner_uid = service_account_object.metadata.uid
 
@@ -1348,8 +1602,10 @@ def create_service_account(spawner, pod):
 
     if owner_uid is None:
         try:
-            service_account_object = service_account_resource.get(
-                    namespace=namespace, name=user_account_name)
+            service_account_object = yield api_call(
+                    service_account_resource.get,
+                    namespace=namespace, name=user_account_name,
+                    priority=priority)
 
             owner_uid = service_account_object.metadata.uid
 
@@ -1364,19 +1620,19 @@ def create_service_account(spawner, pod):
 @gen.coroutine
 def create_project_namespace(spawner, pod, project_name):
     short_name = spawner.user.name
+    priority = spawner_priority(spawner)
     user_account_name = '%s-%s' % (application_name, short_name)
 
     try:
-        text = namespace_template.safe_substitute(
+        body = namespace_template.render(
                 configuration=configuration_type, name=project_name,
                 application_name=application_name,
                 requestor=full_service_account_name, namespace=namespace,
                 deployment=application_name, account=user_account_name,
                 session=pod.metadata.name, owner=project_owner.metadata.name,
                 uid=project_owner.metadata.uid, username=short_name)
-        body = json.loads(text)
 
-        namespace_resource.create(body=body)
+        yield api_call(namespace_resource.create, body=body, priority=priority)
 
     except ApiException as e:
         if e.status != 409:
@@ -1390,28 +1646,20 @@ def create_project_namespace(spawner, pod, project_name):
 @gen.coroutine
 def setup_project_namespace(spawner, pod, project_name, role, budget):
     short_name = spawner.user.name
+    priority = spawner_priority(spawner)
     user_account_name = '%s-%s' % (application_name, short_name)
 
     # Wait for project namespace to exist before continuing.
 
-    for _ in range(30):
-        try:
-            project = namespace_resource.get(name=project_name)
-
-        except ApiException as e:
-            if e.status == 404:
-                yield gen.sleep(0.1)
-                continue
-
-            print('ERROR: Error querying project. %s' % e)
-            raise
-
-        else:
-            break
+    try:
+        project = yield wait_for_resource(namespace_resource, project_name,
+                timeout=10.0, priority=priority)
 
-    else:
-        # If can't verify project created, carry on anyway.
+    except Exception as e:
+        print('ERROR: Error querying project. %s' % e)
+        raise
 
+    if project is None:
         print('ERROR: Could not verify project creation. %s' % project_name)
 
         raise Exception('Could not verify project creation. %s' % project_name)
@@ -1423,13 +1671,13 @@ def setup_project_namespace(spawner, pod, project_name, role, budget):
     # been created yet.
 
     try:
-        text = role_binding_template.safe_substitute(
+        body = role_binding_template.render(
                 configuration=configuration_type, namespace=namespace,
                 name=service_account_name, tag='admin', role='admin',
                 application_name=application_name, username=short_name)
-        body = json.loads(text)
 
-        role_binding_resource.create(namespace=project_name, body=body)
+        yield api_call(role_binding_resource.create,
+                namespace=project_name, body=body, priority=priority)
 
     except ApiException as e:
         if e.status != 409:
@@ -1444,13 +1692,13 @@ def setup_project_namespace(spawner, pod, project_name, role, budget):
     # can create resources in it.
 
     try:
-        text = role_binding_template.safe_substitute(
+        body = role_binding_template.render(
                 configuration=configuration_type, namespace=namespace,
                 name=user_account_name, tag=role, role=role,
                 application_name=application_name, username=short_name)
-        body = json.loads(text)
 
-        role_binding_resource.create(namespace=project_name, body=body)
+        yield api_call(role_binding_resource.create,
+                namespace=project_name, body=body, priority=priority)
 
     except ApiException as e:
         if e.status != 409:
@@ -1466,14 +1714,14 @@ def setup_project_namespace(spawner, pod, project_name, role, budget):
     # rules for a specific workshop session.
 
     try:
-        text = role_binding_template.safe_substitute(
+        body = role_binding_template.render(
                 configuration=configuration_type, namespace=namespace,
                 name=user_account_name, tag='session-rules',
                 role=application_name+'-session-rules',
                 application_name=application_name, username=short_name)
-        body = json.loads(text)
 
-        role_binding_resource.create(namespace=project_name, body=body)
+        yield api_call(role_binding_resource.create,
+                namespace=project_name, body=body, priority=priority)
 
     except ApiException as e:
         if e.status != 409:
@@ -1492,107 +1740,118 @@ def setup_project_namespace(spawner, pod, project_name, role, budget):
         elif not resource_budget_mapping[budget]:
             budget = 'default'
 
-    if budget not in ('default', 'unlimited'):
-        budget_item = resource_budget_mapping[budget]
+    # Reconcile the limit ranges and resource quotas applied to the
+    # project against those required by the budget. For the case of
+    # unlimited, we delete any being applied but don't replace them.
+    # For the case of default, we leave alone whatever is applied.
 
-        resource_limits_definition = budget_item['resource-limits']
-        compute_resources_definition = budget_item['compute-resources']
-        compute_resources_timebound_definition = budget_item['compute-resources-timebound']
-        object_counts_definition = budget_item['object-counts']
+    if budget == 'unlimited':
+        yield reconcile_resource_budget(project_name, {}, priority=priority)
 
-    # Delete any limit ranges applied to the project that may conflict
-    # with the limit range being applied. For the case of unlimited, we
-    # delete any being applied but don't replace it.
+    elif budget != 'default':
+        yield reconcile_resource_budget(project_name,
+                resource_budget_mapping[budget], priority=priority)
 
-    if budget != 'default':
-        try:
-            limit_ranges = limit_range_resource.get(
-                        namespace=project_name)
+    # Return the project UID for later use as owner UID if needed.
 
-        except ApiException as e:
-            print('ERROR: Error querying limit ranges. %s' % e)
-            raise
+    return project_uid
 
-        for limit_range in limit_ranges.items:
-            try:
-                limit_range_resource.delete(namespace=project_name,
-                    name=limit_range.metadata.name)
+# The limit ranges and resource quotas for a budget are reconciled with
+# what already exists in a project, rather than always being deleted and
+# recreated. A hash of the definition is recorded in an annotation on
+# each object so it can be determined whether it needs to be updated.
 
-            except ApiException as e:
-                print('ERROR: Error deleting limit range. %s' % e)
-                raise
+def resource_budget_hash(body):
+    text = json.dumps(body, sort_keys=True)
 
-    # Create limit ranges for the project namespace so any deployments
-    # will have default memory/cpu min and max values.
+    return hashlib.sha256(text.encode('UTF-8')).hexdigest()
 
-    if budget not in ('default', 'unlimited'):
-        try:
-            body = resource_limits_definition
+@gen.coroutine
+def reconcile_resource_objects(resource_type, project_name, definitions,
+        priority=None):
+    kind = resource_type.kind
 
-            limit_range_resource.create(namespace=project_name, body=body)
+    try:
+        objects = yield api_call(resource_type.get, namespace=project_name,
+                priority=priority)
 
-        except ApiException as e:
-            if e.status != 409:
-                print('ERROR: Error creating limit range. %s' % e)
-                raise
+    except ApiException as e:
+        print('ERROR: Error querying %s objects. %s' % (kind, e))
+        raise
 
-    # Delete any resource quotas applied to the project namespace that
-    # may conflict with the resource quotas being applied.
+    existing = dict((obj.metadata.name, obj) for obj in objects.items)
 
-    if budget != 'default':
+    @gen.coroutine
+    def delete_object(name):
         try:
-            resource_quotas = resource_quota_resource.get(namespace=project_name)
+            yield api_call(resource_type.delete, namespace=project_name,
+                    name=name, priority=priority)
 
         except ApiException as e:
-            print('ERROR: Error querying resource quotas. %s' % e)
-            raise
+            if e.status != 404:
+                print('ERROR: Error deleting %s %s. %s' % (kind, name, e))
+                raise
 
-        for resource_quota in resource_quotas.items:
-            try:
-                resource_quota_resource.delete(namespace=project_name,
-                    name=resource_quota.metadata.name)
+    @gen.coroutine
+    def apply_object(name, definition):
+        fingerprint = resource_budget_hash(definition)
 
-            except ApiException as e:
-                print('ERROR: Error deleting resource quota. %s' % e)
-                raise
+        obj = existing.get(name)
+
+        if obj is not None:
+            annotations = obj.metadata.annotations
+            if annotations and annotations['resource-budget-hash'] == fingerprint:
+                return
 
-    # Create resource quotas for the project so there is a maximum for
-    # what resources can be used.
+        body = copy.deepcopy(definition)
+
+        annotations = body['metadata'].setdefault('annotations', {})
+        annotations['resource-budget-hash'] = fingerprint
 
-    if budget not in ('default', 'unlimited'):
         try:
-            body = compute_resources_definition
+            if obj is None:
+                yield api_call(resource_type.create, namespace=project_name,
+                        body=body, priority=priority)
+
+            else:
+                body['metadata']['resourceVersion'] = obj.metadata.resourceVersion
 
-            resource_quota_resource.create(namespace=project_name, body=body)
+                yield api_call(resource_type.replace, namespace=project_name,
+                        body=body, priority=priority)
 
         except ApiException as e:
             if e.status != 409:
-                print('ERROR: Error creating compute resources quota. %s' % e)
+                print('ERROR: Error applying %s %s. %s' % (kind, name, e))
                 raise
 
-        try:
-            body = compute_resources_timebound_definition
+    futures = []
 
-            resource_quota_resource.create(namespace=project_name, body=body)
+    for name in existing:
+        if name not in definitions:
+            futures.append(delete_object(name))
 
-        except ApiException as e:
-            if e.status != 409:
-                print('ERROR: Error creating compute resources timebound quota. %s' % e)
-                raise
+    for name, definition in definitions.items():
+        futures.append(apply_object(name, definition))
 
-        try:
-            body = object_counts_definition
+    yield futures
 
-            resource_quota_resource.create(namespace=project_name, body=body)
+@gen.coroutine
+def reconcile_resource_budget(project_name, budget_item, priority=None):
+    limit_ranges = {}
+    resource_quotas = {}
 
-        except ApiException as e:
-            if e.status != 409:
-                print('ERROR: Error creating object counts quota. %s' % e)
-                raise
+    for definition in budget_item.values():
+        name = definition['metadata']['name']
 
-    # Return the project UID for later use as owner UID if needed.
+        if definition['kind'] == 'LimitRange':
+            limit_ranges[name] = definition
+        elif definition['kind'] == 'ResourceQuota':
+            resource_quotas[name] = definition
 
-    return project_uid
+    yield [reconcile_resource_objects(limit_range_resource, project_name,
+                limit_ranges, priority=priority),
+            reconcile_resource_objects(resource_quota_resource, project_name,
+                resource_quotas, priority=priority)]
 
 extra_resources = {}
 extra_resources_loader = None
@@ -1607,23 +1866,27 @@ if os.path.exists('/opt/app-root/resources/extra_resources.json'):
         extra_resources = fp.read().strip()
         extra_resources_loader = json.loads
 
-def _namespaced_resources():
-    api_groups = api_client.resources.parse_api_groups()
+if extra_resources:
+    extra_resources_template = ResourceTemplate(extra_resources,
+            extra_resources_loader)
 
-    for api in api_groups.values():
-        for domain, items in api.items():
-            for version, group in items.items():
-                try:
-                    for kind in group.resources:
-                        if domain:
-                            version = '%s/%s' % (domain, version)
-                        resource = api_client.resources.get(api_version=version, kind=kind)
-                        if type(resource) == Resource and resource.namespaced:
-                            yield (version, resource.kind)
-                except Exception:
-                    pass
+    if not extra_resources_template.compiled:
+        print('WARNING: Extra resources will be parsed for each session.')
 
-namespaced_resources = set(_namespaced_resources())
+# Need to know which resource types are namespaced when creating extra
+# resources. Working this out is slow, so it is done on demand and the
+# result cached, with the cache being shared with the service which
+# deletes projects. If there are extra resources, start populating the
+# cache in the background so it is ready for the first session.
+
+with open('%s/discovery.py' % helpers_root) as fp:
+    exec(compile(fp.read(), '%s/discovery.py' % helpers_root, 'exec'), globals())
+
+discovery_cache = DiscoveryCache(api_client,
+        kubernetes_server_info.get('gitVersion'))
+
+if extra_resources:
+    api_executor.submit(discovery_cache.get)
 
 @gen.coroutine
 def create_extra_resources(spawner, pod, project_name, owner_uid,
@@ -1632,17 +1895,19 @@ def create_extra_resources(spawner, pod, project_name, owner_uid,
     if not extra_resources:
         return
 
-    template = string.Template(extra_resources)
-    text = template.safe_substitute(spawner_namespace=namespace,
+    priority = spawner_priority(spawner)
+
+    data = extra_resources_template.render(spawner_namespace=namespace,
             project_namespace=project_name, image_registry=image_registry,
             service_account=user_account_name, username=short_name,
             application_name=application_name)
 
-    data = extra_resources_loader(text)
-
     if isinstance(data, dict) and data.get('kind') == 'List':
         data = data['items']
 
+    namespaced_resources = yield api_call(discovery_cache.get,
+            priority=priority)
+
     for body in data:
         try:
             kind = body['kind']
@@ -1654,6 +1919,18 @@ def create_extra_resources(spawner, pod, project_name, owner_uid,
                     controller=True, name=project_name, uid=owner_uid)]
 
             if kind.lower() == 'namespace':
+                # Label the namespace the same as the project for the
+                # session so it is seen by the informers that watch them.
+                # Any labels of the same name given in the template are
+                # overridden, else the namespace would never be deleted.
+
+                labels = body['metadata'].setdefault('labels', {})
+
+                labels['app'] = application_name
+                labels['spawner'] = configuration_type
+                labels['class'] = 'session'
+                labels['user'] = short_name
+
                 annotations = body['metadata'].setdefault('annotations', {})
 
                 annotations['spawner/requestor'] = full_service_account_name
@@ -1662,11 +1939,13 @@ def create_extra_resources(spawner, pod, project_name, owner_uid,
                 annotations['spawner/account'] = user_account_name
                 annotations['spawner/session'] = pod.metadata.name
 
-            resource = api_client.resources.get(api_version=api_version, kind=kind)
+            resource = yield api_call(api_client.resources.get,
+                    api_version=api_version, kind=kind, priority=priority)
 
             target_namespace = body['metadata'].get('namespace', project_name)
 
-            resource.create(namespace=target_namespace, body=body)
+            yield api_call(resource.create, namespace=target_namespace,
+                    body=body, priority=priority)
 
         except ApiException as e:
             if e.status != 409:
@@ -1693,6 +1972,7 @@ def create_extra_resources(spawner, pod, project_name, owner_uid,
 @gen.coroutine
 def expose_service_ports(spawner, pod, owner_uid):
     short_name = spawner.user.name
+    priority = spawner_priority(spawner)
     user_account_name = '%s-%s' % (application_name, short_name)
 
     # Can't do this for now if deployed to plain Kubernetes.
@@ -1706,17 +1986,17 @@ def expose_service_ports(spawner, pod, owner_uid):
         exposed_ports = exposed_ports.split(',')
 
         try:
-            text = service_template.safe_substitute(
+            body = service_template.render(
                     configuration=configuration_type, name=user_account_name,
                     application_name=application_name, username=short_name,
                     uid=owner_uid)
-            body = json.loads(text)
 
             for port in exposed_ports:
                 body['spec']['ports'].append(dict(name='%s-tcp' % port,
                         protocol="TCP", port=int(port), targetPort=int(port)))
 
-            service_resource.create(namespace=namespace, body=body)
+            yield api_call(service_resource.create, namespace=namespace,
+                    body=body, priority=priority)
 
         except ApiException as e:
             if e.status != 409:
@@ -1730,12 +2010,12 @@ def expose_service_ports(spawner, pod, owner_uid):
         for port in exposed_ports:
             try:
                 host = '%s-%s.%s' % (user_account_name, port, cluster_subdomain)
-                text = route_template.safe_substitute(configuration=configuration_type,
+                body = route_template.render(configuration=configuration_type,
                         name=user_account_name, application_name=application_name,
                         port='%s' % port, username=short_name, uid=owner_uid, host=host)
-                body = json.loads(text)
 
-                route_resource.create(namespace=namespace, body=body)
+                yield api_call(route_resource.create, namespace=namespace,
+                        body=body, priority=priority)
 
             except ApiException as e:
                 if e.status != 409:
@@ -1747,41 +2027,525 @@ def expose_service_ports(spawner, pod, owner_uid):
                 raise
 
 @gen.coroutine
-def wait_on_service_account(user_account_name):
-    for _ in range(10):
+def wait_on_service_account(user_account_name, timeout=2.0, priority=None):
+    deadline = time.time() + timeout
+
+    # Hope that all secrets added at same time and don't have to check
+    # names to verify api token secret added.
+
+    try:
+        service_account = yield IOLoop.current().run_in_executor(
+                watch_executor, functools.partial(
+                service_account_informer.wait_for, user_account_name,
+                namespace=namespace, condition=lambda obj: bool(obj.secrets),
+                timeout=timeout))
+
+    except Exception as e:
+        print('ERROR: Error fetching service account. %s' % e)
+        raise
+
+    if service_account is not None:
+        for item in service_account.secrets:
+            try:
+                secret = yield wait_for_resource(secret_resource,
+                        item['name'], namespace=namespace,
+                        timeout=max(0, deadline-time.time()),
+                        priority=priority)
+
+            except Exception as e:
+                print('WARNING: Error fetching secret. %s' % e)
+                break
+
+            if secret is None:
+                break
+
+        else:
+            return
+
+    # If can't verify within the time allowed, continue on anyway.
+
+    print('WARNING: Could not verify account. %s' % user_account_name)
+
+# Where resources for a user persist between sessions, a fingerprint of
+# what was provisioned for each step is recorded against the project for
+# the user so steps can be skipped when nothing has changed. Increment
+# the provisioning version whenever the way resources are provisioned is
+# changed so that all steps will be run again for existing users.
+
+provisioning_version = 1
+
+def provisioning_fingerprint(*values):
+    text = json.dumps([provisioning_version, values], sort_keys=True,
+            default=str)
+
+    return hashlib.sha256(text.encode('UTF-8')).hexdigest()
+
+# Provisioning of the resources for a session is broken up into stages.
+# Each stage is given as a tuple of the names of the stages it depends
+# on and a function to call. The function is passed a dictionary holding
+# the results of the stages it depends on. Stages which don't depend on
+# each other are run concurrently. The result is a dictionary holding
+# the results of all stages. If a stage fails, stages depending on it are
+# not run, but any others already running are allowed to finish before
+# the first error is raised, so nothing is still being created after the
+# spawn has been reported as failed.
+
+@gen.coroutine
+def wait_for_stages(futures):
+    results = {}
+    error = None
+
+    iterator = gen.WaitIterator(**futures)
+
+    while not iterator.done():
         try:
-            service_account = service_account_resource.get(
-                    namespace=namespace, name=user_account_name)
+            results[iterator.current_index] = yield iterator.next()
 
-            # Hope that all secrets added at same time and don't have
-            # to check names to verify api token secret added.
+        except Exception as e:
+            if error is None:
+                error = e
 
-            if service_account.secrets:
-                for item in service_account.secrets:
-                    try:
-                        secret = secret_resource.get(namespace=namespace,
-                                name=item['name'])
+    if error is not None:
+        raise error
 
-                    except Exception as e:
-                        print('WARNING: Error fetching secret. %s' % e)
-                        yield gen.sleep(0.1)
-                        break
+    return results
 
-                else:
-                    break
+@gen.coroutine
+def run_stages(stages):
+    futures = {}
+
+    def schedule(name, path=()):
+        if name not in stages:
+            raise ValueError('Unknown provisioning stage %r.' % name)
+
+        if name in path:
+            raise ValueError('Cyclic dependency on provisioning stage %r.' % name)
+
+        if name not in futures:
+            requires, func = stages[name]
+
+            dependencies = dict((dependency, schedule(dependency, path+(name,)))
+                    for dependency in requires)
+
+            futures[name] = run_stage(func, dependencies)
+
+        return futures[name]
+
+    @gen.coroutine
+    def run_stage(func, dependencies):
+        results = yield wait_for_stages(dependencies)
+        return (yield gen.maybe_future(func(results)))
+
+    for name in stages:
+        schedule(name)
+
+    results = yield wait_for_stages(futures)
+
+    return results
+
+# Maintain a pool of standby pods to reduce the time it takes to start a
+# session. It isn't possible to change the service account or environment
+# of a running pod, so a standby pod can't be handed over to a user.
+# Instead, standby pods are created using the same images and memory as
+# a session, but run under a placeholder identity with a command which
+# does nothing. This results in the images being pulled down to a node
+# and capacity being reserved on it.
+#
+# Standby pods are given a priority class with a negative priority, so
+# that when there is no other capacity for the pod of a session, the
+# scheduler will preempt a standby pod to make room for it. A replacement
+# is then created in the background. The priority class is created if it
+# doesn't already exist, or the name of an existing priority class can be
+# supplied. If the priority class can't be used, a standby pod is instead
+# deleted when a session is being started, with the pool not being
+# replenished until the pod for the session has been scheduled, so the
+# replacement can't take the capacity which was released.
+
+standby_pool_size = int(os.environ.get('STANDBY_POOL_SIZE', '0'))
+
+standby_priority_class = os.environ.get('STANDBY_PRIORITY_CLASS',
+        '%s-standby' % application_name)
+
+standby_priority_value = -10
+
+standby_preemptible = False
+
+standby_pods = []
+
+standby_pods_lock = Lock()
+
+standby_releases_pending = set()
+
+standby_command = ['/bin/sh', '-c', 'while true; do sleep 3600; done']
+
+def standby_pod_template():
+    memory = c.KubeSpawner.get('mem_limit', c.Spawner.get('mem_limit'))
+
+    containers = [
+        {
+            'name': 'workshop',
+            'image': c.KubeSpawner.image,
+            'imagePullPolicy': c.KubeSpawner.get('image_pull_policy',
+                    'IfNotPresent'),
+            'command': standby_command,
+            'resources': {
+                'limits': {
+                    'memory': memory
+                },
+                'requests': {
+                    'memory': memory
+                }
+            }
+        }
+    ]
+
+    for container in c.KubeSpawner.extra_containers:
+        containers.append({
+            'name': container['name'],
+            'image': container['image'],
+            'command': standby_command,
+            'resources': container.get('resources', {})
+        })
+
+    template = {
+        'apiVersion': 'v1',
+        'kind': 'Pod',
+        'metadata': {
+            'generateName': '%s-standby-' % application_name,
+            'labels': {
+                'app': application_name,
+                'spawner': configuration_type,
+                'class': 'standby'
+            }
+        },
+        'spec': {
+            'automountServiceAccountToken': False,
+            'terminationGracePeriodSeconds': 0,
+            'securityContext': {
+                'runAsUser': c.KubeSpawner.uid,
+                'fsGroup': c.KubeSpawner.fs_gid
+            },
+            'containers': containers
+        }
+    }
+
+    if standby_preemptible:
+        template['spec']['priorityClassName'] = standby_priority_class
+
+    return template
+
+def lookup_priority_class():
+    for api_version in ('scheduling.k8s.io/v1', 'scheduling.k8s.io/v1beta1'):
+        resource = lookup_resource_type(api_version, 'PriorityClass',
+                optional=True)
+
+        if resource is None:
+            continue
+
+        try:
+            return resource.get(name=standby_priority_class)
+
+        except ApiException as e:
+            if e.status != 404:
+                raise
+
+        body = {
+            'apiVersion': api_version,
+            'kind': 'PriorityClass',
+            'metadata': {
+                'name': standby_priority_class,
+                'labels': {
+                    'app': application_name
+                }
+            },
+            'value': standby_priority_value,
+            'globalDefault': False,
+            'description': 'Standby pods which can be preempted by sessions.'
+        }
+
+        return resource.create(body=body)
+
+@gen.coroutine
+def setup_standby_priority_class():
+    global standby_preemptible
+
+    try:
+        priority_class = yield background_api_call(lookup_priority_class)
+
+    except Exception as e:
+        print('WARNING: Unable to use priority class %s for standby pods. %s'
+                % (standby_priority_class, e))
+
+        return
+
+    if priority_class is None:
+        print('WARNING: Priority classes are not supported, standby pods '
+                'will be released when sessions start.')
+
+        return
+
+    if priority_class.value >= 0:
+        print('WARNING: Priority class %s does not have a negative priority, '
+                'standby pods will be released when sessions start.' %
+                standby_priority_class)
+
+        return
+
+    standby_preemptible = True
+
+@gen.coroutine
+def replenish_standby_pool():
+    with (yield standby_pods_lock.acquire()):
+        try:
+            pods = yield background_api_call(pod_resource.get,
+                    namespace=namespace, label_selector='app=%s,class=standby'
+                    % application_name)
+
+        except Exception as e:
+            print('ERROR: Failed to query standby pods. %s' % e)
+            return
+
+        standby_pods[:] = []
+
+        for pod in pods.items:
+            if pod.metadata.deletionTimestamp:
+                continue
+
+            # Standby pods left by a prior instance of JupyterHub which
+            # can't be preempted are replaced with ones which can be.
+
+            if (standby_preemptible and pod.spec.priorityClassName !=
+                    standby_priority_class):
+                try:
+                    yield background_api_call(pod_resource.delete,
+                            namespace=namespace, name=pod.metadata.name,
+                            body={'gracePeriodSeconds': 0})
+
+                except Exception as e:
+                    print('ERROR: Failed to delete standby pod %s. %s' % (
+                            pod.metadata.name, e))
 
-            else:
-                yield gen.sleep(0.1)
                 continue
 
+            standby_pods.append(pod.metadata.name)
+
+        # Capacity released for sessions whose pods haven't yet been
+        # scheduled is left free for them.
+
+        shortfall = (standby_pool_size - len(standby_releases_pending) -
+                len(standby_pods))
+
+        for _ in range(shortfall):
+            try:
+                pod = yield background_api_call(pod_resource.create,
+                        namespace=namespace, body=standby_pod_template())
+
+            except Exception as e:
+                print('ERROR: Failed to create standby pod. %s' % e)
+                return
+
+            print('INFO: Created standby pod %s.' % pod.metadata.name)
+
+            standby_pods.append(pod.metadata.name)
+
+@gen.coroutine
+def replenish_when_scheduled(pod_name):
+    try:
+        yield wait_for_resource(pod_resource, pod_name, namespace,
+                condition=lambda pod: pod.spec.nodeName,
+                timeout=c.Spawner.start_timeout)
+
+    except Exception as e:
+        print('ERROR: Failed waiting on pod %s to be scheduled. %s' % (
+                pod_name, e))
+
+    finally:
+        standby_releases_pending.discard(pod_name)
+
+    yield replenish_standby_pool()
+
+@gen.coroutine
+def release_standby_pod(pod):
+    # Where standby pods can be preempted, the scheduler will make room
+    # for the session itself and nothing needs to be done.
+
+    if standby_preemptible:
+        return
+
+    while standby_pods:
+        name = standby_pods.pop(0)
+
+        try:
+            yield api_call(pod_resource.delete, namespace=namespace,
+                    name=name, body={'gracePeriodSeconds': 0})
+
+        except ApiException as e:
+            if e.status != 404:
+                print('ERROR: Failed to delete standby pod %s. %s' % (name, e))
+            continue
+
         except Exception as e:
-            print('ERROR: Error fetching service account. %s' % e)
+            print('ERROR: Failed to delete standby pod %s. %s' % (name, e))
+            continue
+
+        print('INFO: Released standby pod %s.' % name)
+
+        standby_releases_pending.add(pod.metadata.name)
+
+        IOLoop.current().add_callback(replenish_when_scheduled,
+                pod.metadata.name)
+
+        return
+
+@gen.coroutine
+def start_standby_pool():
+    yield setup_standby_priority_class()
+    yield replenish_standby_pool()
+
+    PeriodicCallback(replenish_standby_pool, 15*1000).start()
+
+def enable_standby_pool():
+    if standby_pool_size > 0:
+        IOLoop.current().add_callback(start_standby_pool)
+
+# Admit sessions to be started through a queue, so that when many users
+# arrive at once, such as at the start of a workshop, only a limited
+# number of sessions are being started at the same time. Users are
+# admitted in the order they arrived, and while waiting, the progress
+# page shows their position in the queue and an estimate of how long
+# they will need to wait, based on how long recent sessions took to
+# start. Time spent waiting in the queue doesn't count against the
+# timeout for starting the session. A slot is acquired before the
+# session is started, and released when starting it completes or fails.
+# Releasing is also done when the session is stopped in case starting
+# it failed before it got that far.
+#
+# JupyterHub counts a session waiting in the queue as a pending spawn, so
+# waiting sessions count against its concurrent spawn limit, which
+# defaults to 100. Once that many users are waiting or starting, further
+# users would be rejected rather than queued. When the queue is enabled,
+# the concurrent spawn limit is therefore instead taken from the spawn
+# queue limit, which is the most sessions which can be waiting or
+# starting at one time. It defaults to 0, meaning no limit.
+
+spawn_concurrency = int(os.environ.get('SPAWN_CONCURRENCY', '0'))
+
+spawn_queue_limit = int(os.environ.get('SPAWN_QUEUE_LIMIT', '0'))
+
+spawn_waiters = collections.deque()
+
+spawns_admitted = set()
+
+spawn_durations = collections.deque(maxlen=20)
+
+def spawn_queue_position(spawner):
+    for position, (waiter, _) in enumerate(spawn_waiters, 1):
+        if waiter is spawner:
+            return position
+
+def spawn_queue_estimate(position):
+    if not spawn_durations:
+        return None
+
+    average = sum(spawn_durations) / len(spawn_durations)
+
+    return math.ceil(position / spawn_concurrency) * average
+
+@gen.coroutine
+def admit_spawn(spawner):
+    if spawn_concurrency <= 0 or spawner in spawns_admitted:
+        return
+
+    if len(spawns_admitted) < spawn_concurrency and not spawn_waiters:
+        spawns_admitted.add(spawner)
+        return
+
+    future = Future()
+
+    spawn_waiters.append((spawner, future))
+
+    print('INFO: Queued start of session for %s, position %d.' % (
+            spawner.user.name, len(spawn_waiters)))
+
+    yield future
+
+def release_spawn(spawner):
+    if spawner not in spawns_admitted:
+        return
+
+    spawns_admitted.discard(spawner)
+
+    while spawn_waiters and len(spawns_admitted) < spawn_concurrency:
+        waiter, future = spawn_waiters.popleft()
+
+        if not future.done():
+            spawns_admitted.add(waiter)
+            future.set_result(None)
+
+if spawn_concurrency > 0:
+    c.JupyterHub.concurrent_spawn_limit = spawn_queue_limit
+
+    c.Spawner.pre_spawn_hook = admit_spawn
+
+    c.Spawner.post_stop_hook = release_spawn
+
+    @wrapt.patch_function_wrapper('kubespawner.spawner', 'KubeSpawner.start')
+    def _wrapper_start(wrapped, instance, args, kwargs):
+        started = time.monotonic()
+
+        try:
+            future = gen.convert_yielded(wrapped(*args, **kwargs))
+
+        except Exception:
+            release_spawn(instance)
             raise
 
-    else:
-        # If can't verify after multiple attempts, continue on anyway.
+        def _done(future):
+            if not future.cancelled() and not future.exception():
+                spawn_durations.append(time.monotonic() - started)
+
+            release_spawn(instance)
+
+        future.add_done_callback(_done)
 
-        print('WARNING: Could not verify account. %s' % user_account_name)
+        return future
+
+    @wrapt.patch_function_wrapper('kubespawner.spawner', 'KubeSpawner.progress')
+    async def _wrapper_progress(wrapped, instance, args, kwargs):
+        last_message = None
+
+        while instance.pending == 'spawn':
+            position = spawn_queue_position(instance)
+
+            if position is None:
+                break
+
+            estimate = spawn_queue_estimate(position)
+
+            if estimate is not None:
+                message = ('Waiting to start, position %d in queue, about '
+                        '%d seconds remaining' % (position, estimate))
+            else:
+                message = 'Waiting to start, position %d in queue' % position
+
+            if message != last_message:
+                yield {'progress': 0, 'message': message}
+                last_message = message
+
+            await gen.sleep(1.0)
+
+        # The progress generator of the spawner expects that the session
+        # has already been started, so wait for that to have happened.
+
+        while (instance.pending == 'spawn' and
+                getattr(instance, '_start_future', None) is None):
+            await gen.sleep(0.5)
+
+        if instance.pending != 'spawn':
+            return
+
+        async for event in wrapped(*args, **kwargs):
+            yield event
 
 # Load configuration corresponding to the configuration type.
 
@@ -1802,3 +2566,5 @@ environ_config_file = '/opt/app-root/configs/jupyterhub_config.py'
 if os.path.exists(environ_config_file):
     with open(environ_config_file) as fp:
         exec(compile(fp.read(), environ_config_file, 'exec'), globals())
+
+report_startup_timings()
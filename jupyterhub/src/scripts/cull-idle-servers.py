@@ -30,12 +30,47 @@ culling users and users' servers.  If you want a different value for
 users and servers, you should add this script to the services list
 twice, just with different ``name``s, different values, and one with
 the ``--cull-users`` option.
+
+Rather than checking every user on every ``--cull-every`` interval, the
+time at which each server or user could next be culled is worked out
+when it is checked, and just that user is fetched again when the time
+comes. A full check of all users is still done every ``--cull-every``
+seconds, to pick up new users and servers, but since nothing can be
+culled sooner than ``--timeout`` or ``--max-age`` after being seen, it
+defaults to the smaller of the two.
+
+Because last_activity is only updated coarsely, and is kept current by
+an open browser tab even when nothing is being done, the CPU usage of
+the pods for servers can also be used to decide if they are idle. The
+usage is polled from the Kubernetes metrics API every
+``--metrics-interval`` seconds, and a pod is treated as busy when it
+uses at least ``--cpu-threshold`` millicores. The metrics API doesn't
+report network usage, so only CPU usage is used. The ``--idle-policy``
+option selects how this is used:
+
+- ``activity``: use only last_activity (the default)
+- ``usage``: use only how long since the pod was last busy, falling
+  back to last_activity if there are no metrics for the pod
+- ``combined``: only cull when idle by both measures
+
+For testing, ``--metrics-file`` can name a file holding a PodMetricsList
+in the same form as returned by the metrics API, which will be read in
+place of querying it.
+
+The limit on concurrent requests to the Hub is adjusted according to
+how quickly it responds, between ``--concurrency`` and
+``--max-concurrency``. If ``--metrics-port`` is given, the current limit
+is served at ``/metrics`` on that port in the Prometheus text format.
 """
 
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from functools import partial
+import codecs
+import heapq
 import json
 import os
+import re
+import time
 
 try:
     from urllib.parse import quote
@@ -45,10 +80,12 @@ except ImportError:
 import dateutil.parser
 
 from tornado.gen import coroutine, multi
-from tornado.locks import Semaphore
+from tornado.locks import Condition
+from tornado.queues import Queue
 from tornado.log import app_log
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpclient import AsyncHTTPClient, HTTPError, HTTPRequest
 from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.web import Application, RequestHandler
 from tornado.options import define, options, parse_command_line
 
 
@@ -66,6 +103,14 @@ def parse_date(date_string):
     return dt
 
 
+def parse_cpu(quantity):
+    """Parse a Kubernetes CPU quantity, returning millicores"""
+    units = {'n': 1e-6, 'u': 1e-3, 'm': 1.0}
+    if quantity and quantity[-1] in units:
+        return float(quantity[:-1]) * units[quantity[-1]]
+    return float(quantity or 0) * 1000
+
+
 def format_td(td):
     """
     Nicely format a timedelta object
@@ -84,38 +129,351 @@ def format_td(td):
     return "{h:02}:{m:02}:{seconds:02}".format(h=h, m=m, seconds=seconds)
 
 
+class CullScheduler(object):
+    """Schedule checks of users at the time they could next be culled
+
+    Holds a min-heap of when each user is next due to be checked. When
+    the earliest time arrives, the callback is called with the names of
+    all users which are due. Entries superseded by rescheduling a user
+    to an earlier time are discarded when they reach the top of the heap.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.heap = []
+        self.due = {}
+        self.handle = None
+        self.armed = None
+
+    def schedule(self, name, when):
+        """Schedule a check of user `name` at `when` (a datetime)"""
+        when = when.timestamp()
+        current = self.due.get(name)
+        if current is not None and current <= when:
+            # an earlier check will reschedule if still needed
+            return
+        self.due[name] = when
+        heapq.heappush(self.heap, (when, name))
+        self._arm()
+
+    def _arm(self):
+        loop = IOLoop.current()
+        while self.heap and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return
+        when = self.heap[0][0]
+        if self.handle is not None:
+            if self.armed <= when:
+                return
+            loop.remove_timeout(self.handle)
+        self.armed = when
+        self.handle = loop.call_later(max(0, when - time.time()), self._fire)
+
+    def _fire(self):
+        self.handle = None
+        self.armed = None
+        now = time.time()
+        names = []
+        while self.heap and self.heap[0][0] <= now:
+            when, name = heapq.heappop(self.heap)
+            if self.due.get(name) == when:
+                del self.due[name]
+                names.append(name)
+        self._arm()
+        if names:
+            app_log.debug("Checking %i users due to be culled", len(names))
+            IOLoop.current().add_callback(self.callback, names)
+
+
+class UsageMonitor(object):
+    """Track when the pods for servers were last busy
+
+    Polls the metrics API for the CPU usage of all the pods for servers at
+    once, recording the time each was last seen using at least the
+    threshold. A pod not seen to be busy since monitoring started is
+    treated as having been idle since then, or since the server started.
+    """
+
+    def __init__(self, url, token, threshold, metrics_file=None):
+        self.url = url
+        self.token = token
+        self.threshold = threshold
+        self.metrics_file = metrics_file
+        self.started = datetime.now(timezone.utc)
+        self.last_busy = {}
+        self.seen = set()
+
+    @coroutine
+    def poll(self):
+        try:
+            if self.metrics_file:
+                with open(self.metrics_file) as fp:
+                    data = json.load(fp)
+            else:
+                req = HTTPRequest(
+                    url=self.url,
+                    headers={'Authorization': 'Bearer %s' % self.token},
+                    validate_cert=False,
+                )
+                resp = yield AsyncHTTPClient().fetch(req)
+                data = json.loads(resp.body.decode('utf8', 'replace'))
+        except Exception as e:
+            app_log.warning("Could not fetch pod metrics: %s", e)
+            return
+
+        now = datetime.now(timezone.utc)
+        seen = set()
+        for item in data.get('items') or []:
+            name = item['metadata']['name']
+            cpu = sum(parse_cpu(container.get('usage', {}).get('cpu'))
+                      for container in item.get('containers') or [])
+            seen.add(name)
+            if cpu >= self.threshold:
+                self.last_busy[name] = now
+        for name in list(self.last_busy):
+            if name not in seen:
+                del self.last_busy[name]
+        self.seen = seen
+
+    def inactive(self, pod_name, now, started=None):
+        """How long the pod has been idle, or None if there are no metrics"""
+        if pod_name not in self.seen:
+            return None
+        since = self.last_busy.get(pod_name, self.started)
+        if started is not None and started > since:
+            since = started
+        return now - since
+
+
+class AdaptiveLimiter(object):
+    """Limit concurrent requests, adapting the limit to how the Hub responds
+
+    The limit is adjusted using additive-increase/multiplicative-decrease.
+    Each request which completes within the latency target raises the
+    limit by roughly one per round trip, up to the maximum. A request
+    which fails because the Hub is overloaded, or which is too slow,
+    halves the limit, at most once per round trip, down to the minimum.
+    """
+
+    def __init__(self, initial, maximum, latency_target=1.0, minimum=1):
+        self.maximum = max(maximum, initial)
+        self.minimum = min(minimum, initial)
+        self.limit = float(initial)
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.condition = Condition()
+        self.last_decrease = 0
+        self.reported = self.current
+
+    @property
+    def current(self):
+        return max(self.minimum, int(self.limit))
+
+    @coroutine
+    def acquire(self):
+        while self.in_flight >= self.current:
+            yield self.condition.wait()
+        self.in_flight += 1
+
+    def release(self, latency, failed=False):
+        self.in_flight -= 1
+        now = time.monotonic()
+        if failed or latency > self.latency_target:
+            if now - self.last_decrease > latency:
+                self.limit = max(self.minimum, self.limit / 2)
+                self.last_decrease = now
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        if self.current != self.reported:
+            log = app_log.info if self.current < self.reported else app_log.debug
+            log("Concurrency limit now %i (latency %.3fs%s)",
+                self.current, latency, failed and ", failed" or "")
+            self.reported = self.current
+        self.condition.notify_all()
+
+
+class LimiterMetricsHandler(RequestHandler):
+    """Report the state of the limiter in the Prometheus text format"""
+
+    def initialize(self, limiter):
+        self.limiter = limiter
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        for name, description, value in [
+            ('cull_idle_concurrency_limit',
+             "Current limit on concurrent requests to the Hub",
+             self.limiter.current),
+            ('cull_idle_concurrency_limit_max',
+             "Maximum the limit on concurrent requests can be raised to",
+             self.limiter.maximum),
+            ('cull_idle_requests_in_flight',
+             "Number of requests to the Hub in progress",
+             self.limiter.in_flight),
+        ]:
+            self.write('# HELP %s %s\n' % (name, description))
+            self.write('# TYPE %s gauge\n' % name)
+            self.write('%s %s\n' % (name, value))
+
+
+class UserListDecoder(object):
+    """Decode a JSON list of users incrementally as it is received
+
+    Chunks of the response are passed to feed() as they arrive, and are
+    only parsed when the next user is asked for with pop(), so users are
+    not all decoded at once. The Hub can't be made to send the response
+    more slowly, so chunks which arrive faster than users are checked
+    are kept, but only as text.
+    """
+
+    whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf8')('replace')
+        self.json = json.JSONDecoder()
+        self.chunks = []
+        self.buffer = ''
+        self.pos = 0
+        self.state = 'start'
+        self.condition = Condition()
+
+    def feed(self, chunk):
+        self.chunks.append(self.decoder.decode(chunk))
+        self.condition.notify_all()
+
+    def _more(self):
+        """Add any chunks received to the buffer, returning if there were any"""
+        if not self.chunks:
+            return False
+        self.buffer = self.buffer[self.pos:] + ''.join(self.chunks)
+        self.chunks = []
+        self.pos = 0
+        return True
+
+    def pop(self):
+        """Return the next user, or None if more of the response is needed"""
+        while self.state != 'end':
+            pos = self.whitespace.match(self.buffer, self.pos).end()
+            if pos == len(self.buffer):
+                if not self._more():
+                    return None
+                continue
+            char = self.buffer[pos]
+            if self.state == 'start':
+                if char != '[':
+                    raise ValueError("Expected a list of users")
+                self.state = 'item'
+                self.pos = pos + 1
+            elif char == ']':
+                self.state = 'end'
+                self.pos = pos + 1
+            elif self.state == 'next':
+                if char != ',':
+                    raise ValueError("Expected ',' at %i" % pos)
+                self.state = 'item'
+                self.pos = pos + 1
+            else:
+                try:
+                    user, end = self.json.raw_decode(self.buffer, pos)
+                except ValueError:
+                    # assume the user is incomplete, close() will raise
+                    # if the response ends here
+                    if not self._more():
+                        return None
+                    continue
+                self.state = 'next'
+                self.pos = end
+                return user
+        return None
+
+    def close(self):
+        """Check that the whole list was received"""
+        self.chunks.append(self.decoder.decode(b'', final=True))
+        if self.state != 'end':
+            raise ValueError("Incomplete list of users")
+
+
 @coroutine
-def cull_idle(url, api_token, inactive_limit, cull_users=False, max_age=0, concurrency=10):
+def cull_idle(url, api_token, inactive_limit, cull_users=False, max_age=0, concurrency=10,
+              scheduler=None, names=None, page_size=200, limiter=None,
+              usage=None, idle_policy='activity'):
     """Shutdown idle single-user servers
 
     If cull_users, inactive *users* will be deleted as well.
+
+    Users are fetched page_size at a time and checked by a bounded set
+    of workers. If names is given, only those users are fetched and
+    checked, rather than all users. If a scheduler is given, users which
+    can't yet be culled are scheduled to be checked again when they next
+    could be.
+
+    If a limiter is given, it is used to limit concurrent requests to the
+    Hub rather than a fixed limit of concurrency.
+
+    If usage is given, how long the pod for a server has been idle is
+    combined with last_activity according to idle_policy.
     """
     auth_header = {
         'Authorization': 'token %s' % api_token,
     }
-    req = HTTPRequest(
-        url=url + '/users',
-        headers=auth_header,
-    )
     now = datetime.now(timezone.utc)
     client = AsyncHTTPClient()
 
+    if concurrency and limiter is None:
+        limiter = AdaptiveLimiter(concurrency, concurrency)
+
     if concurrency:
-        semaphore = Semaphore(concurrency)
         @coroutine
         def fetch(req):
-            """client.fetch wrapped in a semaphore to limit concurrency"""
-            yield semaphore.acquire()
+            """client.fetch wrapped in a limiter to limit concurrency"""
+            yield limiter.acquire()
+            start = time.monotonic()
+            failed = False
             try:
                 return (yield client.fetch(req))
+            except HTTPError as e:
+                # 599 is used for timeouts and connection errors
+                failed = e.code == 429 or e.code >= 500
+                raise
+            except Exception:
+                failed = True
+                raise
             finally:
-                yield semaphore.release()
+                limiter.release(time.monotonic() - start, failed)
     else:
         fetch = client.fetch
 
-    resp = yield fetch(req)
-    users = json.loads(resp.body.decode('utf8', 'replace'))
-    futures = []
+    workers = limiter and int(limiter.maximum) or 10
+    checked = 0
+    deleted = 0
+
+    @coroutine
+    def fetch_user(name):
+        """Fetch a single user, returning None if they can't be fetched"""
+        req = HTTPRequest(
+            url=url + '/users/%s' % quote(name),
+            headers=auth_header,
+        )
+        try:
+            resp = yield fetch(req)
+        except HTTPError as e:
+            if e.code != 404:
+                app_log.error("Error fetching user %s: %s", name, e)
+            return None
+        return json.loads(resp.body.decode('utf8', 'replace'))
+
+    def schedule(name, inactive, age):
+        """Schedule the next check for when inactive or age hit the limits"""
+        if scheduler is None:
+            return
+        deadlines = []
+        if inactive is not None:
+            deadlines.append(now + timedelta(seconds=inactive_limit) - inactive)
+        if max_age and age is not None:
+            deadlines.append(now + timedelta(seconds=max_age) - age)
+        if deadlines:
+            scheduler.schedule(name, min(deadlines))
 
     @coroutine
     def handle_server(user, server_name, server):
@@ -163,6 +521,18 @@ def cull_idle(url, api_token, inactive_limit, cull_users=False, max_age=0, concu
             # for running servers
             inactive = age
 
+        # check how long the pod has been idle if using the metrics.
+        # The pod name is only available from the spawner state.
+        if usage is not None and idle_policy != 'activity':
+            pod_name = (server.get('state') or {}).get('pod_name')
+            started = server.get('started') and parse_date(server['started'])
+            idle = usage.inactive(pod_name, now, started)
+            if idle is not None:
+                if idle_policy == 'usage' or inactive is None:
+                    inactive = idle
+                else:
+                    inactive = min(inactive, idle)
+
         should_cull = (inactive is not None and
                        inactive.total_seconds() >= inactive_limit)
         if should_cull:
@@ -184,6 +554,7 @@ def cull_idle(url, api_token, inactive_limit, cull_users=False, max_age=0, concu
             app_log.debug(
                 "Not culling server %s (age: %s, inactive for %s)",
                 log_name, format_td(age), format_td(inactive))
+            schedule(user['name'], inactive, age)
             return False
 
         req = HTTPRequest(
@@ -280,6 +651,7 @@ def cull_idle(url, api_token, inactive_limit, cull_users=False, max_age=0, concu
             app_log.debug(
                 "Not culling user %s (created: %s, last active: %s)",
                 user['name'], format_td(age), format_td(inactive))
+            schedule(user['name'], inactive, age)
             return False
 
         req = HTTPRequest(
@@ -290,17 +662,113 @@ def cull_idle(url, api_token, inactive_limit, cull_users=False, max_age=0, concu
         yield fetch(req)
         return True
 
-    for user in users:
-        futures.append((user['name'], handle_user(user)))
+    # Users are handed to a fixed number of workers through a bounded
+    # queue, so the amount of work in flight, and the number of users
+    # held in memory, doesn't grow with the total number of users.
+    queue = Queue(maxsize=workers)
 
-    for (name, f) in futures:
-        try:
-            result = yield f
-        except Exception:
-            app_log.exception("Error processing %s", name)
+    @coroutine
+    def worker():
+        nonlocal checked, deleted
+        while True:
+            item = yield queue.get()
+            if item is None:
+                return
+            name = item if isinstance(item, str) else item['name']
+            try:
+                if isinstance(item, str):
+                    user = yield fetch_user(item)
+                    if user is None:
+                        continue
+                else:
+                    user = item
+                checked += 1
+                result = yield handle_user(user)
+            except Exception:
+                app_log.exception("Error processing %s", name)
+            else:
+                if result:
+                    deleted += 1
+                    app_log.debug("Finished culling %s", name)
+            finally:
+                queue.task_done()
+
+    worker_futures = [worker() for i in range(workers)]
+
+    try:
+        if names is not None:
+            for name in names:
+                yield queue.put(name)
         else:
-            if result:
-                app_log.debug("Finished culling %s", name)
+            # Fetch users a page at a time. Versions of JupyterHub which
+            # don't support pagination, including JupyterHub 1.1, ignore
+            # offset and limit and return all users. This is detected by
+            # more users than the limit being returned, in which case all
+            # users are handed to the workers and nothing more is fetched.
+            # Each response is decoded as it is received, so users are
+            # handed over as they arrive rather than the whole list being
+            # decoded at once. The Hub can't be made to send the list any
+            # slower though, so the part not yet checked is still held in
+            # memory, as text rather than decoded users.
+            #
+            # When paginating, each page is finished before the next is
+            # fetched, and the offset is moved back by the number of users
+            # deleted, since they no longer take up a place in the list.
+            # Otherwise as many users would be skipped until the next pass.
+            offset = 0
+            first = None
+            while True:
+                decoder = UserListDecoder()
+                req = HTTPRequest(
+                    url=url + '/users?offset=%i&limit=%i' % (offset, page_size),
+                    headers=auth_header,
+                    streaming_callback=decoder.feed,
+                )
+                response = fetch(req)
+                response.add_done_callback(
+                    lambda f, condition=decoder.condition: condition.notify_all())
+                count = 0
+                repeated = False
+                deleted_before = deleted
+                while True:
+                    user = decoder.pop()
+                    if user is None:
+                        if response.done():
+                            break
+                        yield decoder.condition.wait()
+                        continue
+                    if not count:
+                        if offset and user['name'] == first:
+                            # offset was ignored and we got the first page again
+                            repeated = True
+                            break
+                        if not offset:
+                            first = user['name']
+                    count += 1
+                    yield queue.put(user)
+                    user = None
+                yield response
+                if repeated:
+                    break
+                decoder.close()
+                if count > page_size:
+                    app_log.debug(
+                        "Hub ignored pagination, got all %i users at once",
+                        count)
+                    break
+                if count != page_size:
+                    break
+                yield queue.join()
+                offset += count - (deleted - deleted_before)
+    finally:
+        for i in range(workers):
+            yield queue.put(None)
+        yield multi(worker_futures)
+
+    if limiter is not None:
+        app_log.info(
+            "Checked %i users, concurrency limit %i",
+            checked, limiter.current)
 
 
 if __name__ == '__main__':
@@ -311,7 +779,10 @@ if __name__ == '__main__':
     )
     define('timeout', default=600, help="The idle timeout (in seconds)")
     define('cull_every', default=0,
-           help="The interval (in seconds) for checking for idle servers to cull")
+           help="""The interval (in seconds) for checking all users for idle servers to cull.
+
+                Defaults to the smaller of timeout and max_age.
+                """)
     define('max_age', default=0,
            help="The maximum age (in seconds) of servers that should be culled even if they are active")
     define('cull_users', default=False,
@@ -323,23 +794,97 @@ if __name__ == '__main__':
 
                 Deleting a lot of users at the same time can slow down the Hub,
                 so limit the number of API requests we have outstanding at any given time.
+                This is the initial limit, which is then adjusted up to max_concurrency
+                depending on how quickly the Hub responds. Use 0 for no limit.
                 """
            )
+    define('max_concurrency', default=50,
+           help="The maximum the limit on concurrent requests can be raised to")
+    define('metrics_port', default=int(os.environ.get('CULLER_METRICS_PORT', '0')),
+           help="""Port on which to serve the current limit on concurrent requests,
+                and related values, in the Prometheus text format at /metrics.
+                Use 0 to not serve them.""")
+    define('latency_target', default=1.0,
+           help="""Response time (in seconds) from the Hub above which the limit
+                on concurrent requests is reduced""")
+    define('page_size', default=200,
+           help="""The number of users to fetch from the Hub at a time. JupyterHub
+                1.1 doesn't support pagination and always returns all users, in
+                which case this has no effect, and the users not yet checked are
+                held in memory as the list is received.""")
+    define('idle_policy', default=os.environ.get('IDLE_POLICY', 'activity'),
+           help="""How to decide if a server is idle. One of 'activity', 'usage'
+                or 'combined'.""")
+    define('cpu_threshold', default=float(os.environ.get('IDLE_CPU_THRESHOLD', '10')),
+           help="CPU usage (in millicores) at or above which a pod is busy")
+    define('metrics_interval', default=60,
+           help="The interval (in seconds) for polling the metrics of pods")
+    define('metrics_file', default='',
+           help="File to read pod metrics from in place of the metrics API")
 
     parse_command_line()
     if not options.cull_every:
-        options.cull_every = options.timeout // 2
+        options.cull_every = options.timeout
+        if options.max_age:
+            options.cull_every = min(options.timeout, options.max_age)
     api_token = os.environ['JUPYTERHUB_API_TOKEN']
+    if options.idle_policy not in ('activity', 'usage', 'combined'):
+        raise ValueError("Invalid idle policy %r" % options.idle_policy)
 
+    # The HTTP client queues requests beyond max_clients, which defaults
+    # to 10, so it needs to allow as many as the limiter can be raised to
+    # or the limit would have no effect beyond that.
+    max_clients = max(10, options.concurrency, options.max_concurrency)
     try:
-        AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
+        AsyncHTTPClient.configure(
+            "tornado.curl_httpclient.CurlAsyncHTTPClient",
+            max_clients=max_clients)
     except ImportError as e:
         app_log.warning(
             "Could not load pycurl: %s\n"
             "pycurl is recommended if you have a large number of users.",
             e)
+        AsyncHTTPClient.configure(None, max_clients=max_clients)
 
     loop = IOLoop.current()
+    scheduler = CullScheduler()
+    limiter = None
+    if options.concurrency:
+        limiter = AdaptiveLimiter(
+            options.concurrency,
+            options.max_concurrency,
+            latency_target=options.latency_target,
+        )
+        if options.metrics_port:
+            Application([
+                (r'/metrics', LimiterMetricsHandler, dict(limiter=limiter)),
+            ]).listen(options.metrics_port)
+    usage = None
+    if options.idle_policy != 'activity':
+        service_account_path = '/var/run/secrets/kubernetes.io/serviceaccount'
+        metrics_url = None
+        token = None
+        if not options.metrics_file:
+            with open(os.path.join(service_account_path, 'namespace')) as fp:
+                namespace = fp.read().strip()
+            with open(os.path.join(service_account_path, 'token')) as fp:
+                token = fp.read().strip()
+            metrics_url = 'https://%s:%s/apis/metrics.k8s.io/v1beta1/namespaces/%s/pods' % (
+                os.environ['KUBERNETES_SERVICE_HOST'],
+                os.environ['KUBERNETES_SERVICE_PORT'],
+                namespace,
+            )
+            if os.environ.get('APPLICATION_NAME'):
+                metrics_url += '?labelSelector=%s' % quote(
+                    'app=%s' % os.environ['APPLICATION_NAME'])
+        usage = UsageMonitor(
+            metrics_url,
+            token,
+            options.cpu_threshold,
+            metrics_file=options.metrics_file,
+        )
+        loop.add_callback(usage.poll)
+        PeriodicCallback(usage.poll, 1e3 * options.metrics_interval).start()
     cull = partial(
         cull_idle,
         url=options.url,
@@ -348,7 +893,13 @@ if __name__ == '__main__':
         cull_users=options.cull_users,
         max_age=options.max_age,
         concurrency=options.concurrency,
+        scheduler=scheduler,
+        page_size=options.page_size,
+        limiter=limiter,
+        usage=usage,
+        idle_policy=options.idle_policy,
     )
+    scheduler.callback = lambda names: cull(names=names)
     # schedule first cull immediately
     # because PeriodicCallback doesn't start until the end of the first interval
     loop.add_callback(cull)
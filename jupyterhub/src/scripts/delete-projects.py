@@ -1,14 +1,17 @@
 import threading
 import time
 import os
+import re
 
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from kubernetes.client.rest import ApiException
 
 from kubernetes.client.configuration import Configuration
 from kubernetes.config.incluster_config import load_incluster_config
 from kubernetes.client.api_client import ApiClient
+from kubernetes.client import VersionApi
 from openshift.dynamic import DynamicClient, Resource
 
 service_account_path = '/var/run/secrets/kubernetes.io/serviceaccount'
@@ -36,10 +39,21 @@ full_service_account_name = 'system:serviceaccount:%s:%s' % (namespace,
 
 load_incluster_config()
 
+# Deletions are done by a bounded pool of worker threads, limited to a
+# maximum rate of requests, so that a large number of sessions ending at
+# the same time are cleaned up quickly without overloading the REST API
+# server or the namespace controller. Make sure the connection pool is
+# big enough for the workers and the informers.
+
+deletion_workers = int(os.environ.get('DELETION_WORKERS', '8'))
+deletion_rate = float(os.environ.get('DELETION_RATE', '10'))
+
 import urllib3
 urllib3.disable_warnings()
 instance = Configuration()
 instance.verify_ssl = False
+instance.connection_pool_maxsize = max(instance.connection_pool_maxsize,
+        deletion_workers + 4)
 Configuration.set_default(instance)
 
 api_client = DynamicClient(ApiClient())
@@ -56,27 +70,103 @@ namespace_resource = api_client.resources.get(
 role_binding_resource = api_client.resources.get(
      api_version='rbac.authorization.k8s.io/v1', kind='RoleBinding')
 
+# Use the cache of which resource types are namespaced shared with the
+# JupyterHub instance, rather than working it out each time.
+
+helpers_root = '/opt/app-root/src/helpers'
+
+with open('%s/records.py' % helpers_root) as fp:
+    exec(compile(fp.read(), '%s/records.py' % helpers_root, 'exec'), globals())
+
+with open('%s/discovery.py' % helpers_root) as fp:
+    exec(compile(fp.read(), '%s/discovery.py' % helpers_root, 'exec'), globals())
+
+discovery_cache = DiscoveryCache(api_client,
+        VersionApi(api_client.client).get_code().git_version)
+
+# Projects, accounts and pods for sessions are cached in memory by
+# informers, rather than listing all of them, or looking up each pod
+# individually, every time a check is done. Only labels and annotations
+# are looked at, so the informers only fetch the metadata of objects.
+
+with open('%s/informers.py' % helpers_root) as fp:
+    exec(compile(fp.read(), '%s/informers.py' % helpers_root, 'exec'), globals())
+
+with open('%s/ratelimit.py' % helpers_root) as fp:
+    exec(compile(fp.read(), '%s/ratelimit.py' % helpers_root, 'exec'), globals())
+
+deletion_limiter = TokenBucket(deletion_rate)
+
+# All requests can additionally be limited to a maximum overall rate, in
+# which case the informers are served ahead of the deletions, which are
+# garbage collection. This budget is separate to that of JupyterHub, and
+# priorities only apply to requests from this process, so JupyterHub
+# passes a smaller rate which is taken out of its own.
+
+api_request_rate = float(os.environ.get('DELETION_REQUEST_RATE', '0'))
+api_request_burst = float(os.environ.get('DELETION_REQUEST_BURST', '0'))
+
+default_request_priority = 'gc'
+
+api_request_limiter = PriorityTokenBucket(api_request_rate, api_request_burst)
+
+gate_api_requests(api_client, api_request_limiter)
+
+deletion_executor = ThreadPoolExecutor(max_workers=deletion_workers)
+
+purge_executor = ThreadPoolExecutor(max_workers=deletion_workers)
+
+namespace_informer = Informer(api_client, namespace_resource,
+        label_selector='app=%s' % application_name,
+        metadata_only=True).start()
+
+service_account_informer = Informer(api_client, service_account_resource,
+        namespace=namespace,
+        label_selector='app=%s,user' % application_name,
+        metadata_only=True).start()
+
+pod_informer = Informer(api_client, pod_resource, namespace=namespace,
+        label_selector='app=%s' % application_name,
+        metadata_only=True).start()
+
+informers = (namespace_informer, service_account_informer, pod_informer)
+
+# Projects and accounts are deleted once they have been unused for the
+# grace period.
+
+grace_period = 90.0
+
+resync_interval = 60.0
+
 project_cache = {}
 account_cache = {}
 orphan_cache = {}
 
+# Projects provisioned ahead of time for the warm pool of environments
+# will not have a pod until claimed, so need to be treated as in use.
+
+pooled_projects = set()
+
 Namespace = namedtuple('Namespace', ['name', 'account', 'pod'])
 
 def get_projects():
     project_details = []
 
-    try:
-        projects = namespace_resource.get(namespace=namespace)
+    pooled_projects.clear()
 
-        for project in projects.items:
+    try:
+        for project in namespace_informer.list():
             annotations = project.metadata.annotations
             if annotations:
-                if (annotations['spawner/requestor'] == full_service_account_name and 
-                        annotations['spawner/namespace'] == namespace and
-                        annotations['spawner/deployment'] == application_name):
+                if (annotations.get('spawner/requestor') == full_service_account_name and 
+                        annotations.get('spawner/namespace') == namespace and
+                        annotations.get('spawner/deployment') == application_name):
                     project_details.append(Namespace(project.metadata.name,
-                            annotations['spawner/account'],
-                            annotations['spawner/session']))
+                            annotations.get('spawner/account'),
+                            annotations.get('spawner/session')))
+
+                    if annotations.get('spawner/pool') == 'available':
+                        pooled_projects.add(project.metadata.name)
 
     except Exception as e:
         print('ERROR: failed to list projects:', e)
@@ -87,12 +177,10 @@ def get_accounts():
     account_details = []
 
     try:
-        accounts = service_account_resource.get(namespace=namespace)
-
-        for account in accounts.items:
+        for account in service_account_informer.list():
             labels = account.metadata.labels
-            application_label = labels and labels['app']
-            if application_label == application_name and labels['user']:
+            application_label = labels and labels.get('app')
+            if application_label == application_name and labels.get('user'):
                 account_details.append(account)
 
     except Exception as e:
@@ -100,87 +188,131 @@ def get_accounts():
 
     return account_details
 
-def pod_exists(name):
+def get_pods():
     try:
-        pod_resource.get(namespace=namespace, name=name)
+        return set(pod.metadata.name for pod in pod_informer.list())
+
+    except Exception as e:
+        print('ERROR: failed to list pods:', e)
+
+    return None
+
+def namespaced_resources():
+    for api_version, kind in sorted(discovery_cache.get()):
+        try:
+            yield api_client.resources.get(api_version=api_version, kind=kind)
+        except Exception:
+            pass
+
+def purge_resources(name, resource_type):
+    try:
+        objects, _ = retry_request(deletion_limiter, list_metadata,
+                api_client, resource_type, namespace=name)
+
+        for obj in objects:
+            if obj.metadata.deletionTimestamp and obj.metadata.finalizers:
+                # Since the project is stuck in terminating, we
+                # remove any finalizers which might be blocking
+                # it. Finalizers can be left around with nothing
+                # to remove them because there is no gaurantee
+                # what order resources will be deleted when a
+                # project is deleted. Thus an application, for
+                # example an operator which would remove the
+                # finalizer when a CRD is deleted, might get
+                # deleted before the objects with the finalizer,
+                # and so the objects can't then be deleted.
+
+                body = {
+                    'kind': resource_type.kind,
+                    'apiVersion': resource_type.group_version,
+                    'metadata': {
+                        'name': obj.metadata.name,
+                        'finalizers': None
+                    }
+                }
+
+                print('WARNING: deleting finalizers on resource: %s' % body)
+
+                try:
+                    retry_request(deletion_limiter, resource_type.patch,
+                            namespace=name, body=body,
+                            content_type='application/merge-patch+json')
 
-        return True
+                except ApiException as e:
+                    print('ERROR: failed to delete finalizers: %s' % body, e)
+
+                except Exception as e:
+                    print('ERROR: failed to delete finalizers: %s' % body, e)
 
     except ApiException as e:
-        if e.status != 404:
-            print('ERROR: failed to lookup pod %s:' % name, e)
+        if e.status not in (403, 404, 405):
+            print('ERROR: failed to query resources %s' % resource_type, e)
 
     except Exception as e:
-        print('ERROR: failed to lookup pod %s:' % name, e)
+        print('ERROR: failed to query resources %s' % resource_type, e)
 
-    return False
+# When a namespace is stuck terminating, the namespace controller records
+# in the status of the namespace which types of resources still have
+# content, with a message of the form "Some resources are remaining:
+# configmaps. has 1 resource instances, widgets.example.com has 2
+# resource instances". Where this is available, only those types need
+# to be checked for finalizers, rather than every type in the cluster.
 
-def namespaced_resources():
-    api_groups = api_client.resources.parse_api_groups()
+remaining_content_pattern = re.compile(
+        r'([a-z0-9-]+)\.([a-z0-9.-]*) has \d+ resource instances')
 
-    for api in api_groups.values():
-        for domain, items in api.items():
-            for version, group in items.items():
-                try:
-                    for kind in group.resources:
-                        if domain:
-                            version = '%s/%s' % (domain, version)
-                        resource = api_client.resources.get(api_version=version, kind=kind)
-                        if type(resource) == Resource and resource.namespaced:
-                            yield resource
-                except Exception:
-                    pass
+def remaining_resource_types(name):
+    try:
+        project = retry_request(deletion_limiter, namespace_resource.get,
+                name=name)
+
+    except Exception as e:
+        print('ERROR: failed to lookup project %s:' % name, e)
+        return None
+
+    remaining = set()
+
+    for condition in (project.status and project.status.conditions) or []:
+        if (condition.type == 'NamespaceContentRemaining' and
+                condition.status == 'True' and condition.message):
+            remaining.update(remaining_content_pattern.findall(
+                    condition.message))
+
+    if not remaining:
+        return None
+
+    resource_types = []
 
-def purge_project(name):
     for resource_type in namespaced_resources():
-        try:
-            objects = resource_type.get(namespace=name)
-            for obj in objects.items:
-                if obj.metadata.deletionTimestamp and obj.metadata.finalizers:
-                    # Since the project is stuck in terminating, we
-                    # remove any finalizers which might be blocking
-                    # it. Finalizers can be left around with nothing
-                    # to remove them because there is no gaurantee
-                    # what order resources will be deleted when a
-                    # project is deleted. Thus an application, for
-                    # example an operator which would remove the
-                    # finalizer when a CRD is deleted, might get
-                    # deleted before the objects with the finalizer,
-                    # and so the objects can't then be deleted.
-
-                    body = {
-                        'kind': obj.kind,
-                        'apiVersion': obj.apiVersion,
-                        'metadata': {
-                            'name': obj.metadata.name,
-                            'finalizers': None
-                        }
-                    }
+        if (resource_type.name, resource_type.group or '') in remaining:
+            remaining.discard((resource_type.name, resource_type.group or ''))
+            resource_types.append(resource_type)
 
-                    print('WARNING: deleting finalizers on resource: %s' % body)
+    for plural, group in remaining:
+        print('WARNING: unknown resource type %s.%s in project %s' % (
+                plural, group, name))
 
-                    try:
-                        resource_type.patch(namespace=name, body=body,
-                                content_type='application/merge-patch+json')
+    return resource_types
 
-                    except ApiException as e:
-                        print('ERROR: failed to delete finalizers: %s' % body, e)
+def purge_project(name):
+    resource_types = remaining_resource_types(name)
 
-                    except Exception as e:
-                        print('ERROR: failed to delete finalizers: %s' % body, e)
+    if resource_types is None:
+        print('INFO: checking all resource types in project %s' % name)
+        resource_types = list(namespaced_resources())
 
-        except ApiException as e:
-            if e.status not in (403, 404, 405):
-                print('ERROR: failed to query resources %s' % resource_type, e)
+    # The resource types are checked in parallel, but waited on before
+    # returning so the worker isn't given more work until finished.
 
-        except Exception as e:
-            print('ERROR: failed to query resources %s' % resource_type, e)
+    futures = [purge_executor.submit(purge_resources, name, resource_type)
+            for resource_type in resource_types]
 
-    pass
+    for future in futures:
+        future.result()
 
 def delete_project(name):
     try:
-        namespace_resource.delete(name=name)
+        retry_request(deletion_limiter, namespace_resource.delete, name=name)
 
         print('INFO: deleted project %s' % name)
 
@@ -198,7 +330,8 @@ def delete_project(name):
 
 def delete_account(name):
     try:
-        service_account_resource.delete(namespace=namespace, name=name)
+        retry_request(deletion_limiter, service_account_resource.delete,
+                namespace=namespace, name=name)
         print('INFO: deleted account %s' % name)
 
     except ApiException as e:
@@ -210,37 +343,99 @@ def delete_account(name):
     except Exception as e:
         print('ERROR: failed to delete account %s:' % name, e)
 
+# Track which deletions have been handed to the workers and not yet
+# completed, so the same one isn't queued again by a later check.
+
+deletions_lock = threading.Lock()
+deletions_pending = set()
+
+def schedule_deletion(func, name):
+    key = (func.__name__, name)
+
+    with deletions_lock:
+        if key in deletions_pending:
+            return
+        deletions_pending.add(key)
+
+    def run():
+        try:
+            func(name)
+        finally:
+            with deletions_lock:
+                deletions_pending.discard(key)
+
+    deletion_executor.submit(run)
+
 def purge():
+    # Until all the informers have listed the current objects, it would
+    # look like pods for sessions don't exist, so don't do anything.
+
+    for informer in informers:
+        if not informer.synced:
+            print('WARNING: waiting for %s informer to sync' %
+                    informer.resource.kind)
+            return None
+
     now = time.time()
 
     projects = get_projects()
 
-    if projects:
-        print('INFO: checking for projects to be deleted: %s' % projects)
+    for project in projects:
+        account_cache.setdefault(project.account, set()).add(project)
+
+    # Take one snapshot of the names of the pods for sessions and check
+    # the projects against that. If it can't be obtained, don't treat
+    # any project as being unused this time. The project cache records
+    # when a project was first seen to be unused, or None if in use.
+    # Checks are run whenever anything changes, so only projects which
+    # have just been seen to be unused are logged.
+
+    pods = get_pods()
 
     for project in projects:
-        if not project in project_cache:
+        if (pods is None or project.name in pooled_projects or
+                project.pod in pods):
+            project_cache[project] = None
+
+        elif project_cache.get(project) is None:
+            print('INFO: project %s is unused, deleting in %.0f seconds' % (
+                    project.name, grace_period))
+
             project_cache[project] = now
 
-        account_cache.setdefault(project.account, set()).add(project)
+    # Projects which have gone away since the last check will be cleaned
+    # up once the grace period has expired from when they were missed.
+
+    current = set(projects)
+
+    for project, unused_since in list(project_cache.items()):
+        if unused_since is None and project not in current:
+            print('INFO: project %s has gone, deleting in %.0f seconds' % (
+                    project.name, grace_period))
 
-    for project in projects:
-        if pod_exists(project.pod):
             project_cache[project] = now
 
-    for project, last_seen in list(project_cache.items()):
-        if now - last_seen > 90.0:
+    deadlines = []
+
+    for project, unused_since in list(project_cache.items()):
+        if unused_since is None:
+            continue
+
+        if now - unused_since >= grace_period:
             account_cache[project.account].remove(project)
 
             if not account_cache[project.account]:
-                delete_account(project.account)
+                schedule_deletion(delete_account, project.account)
 
                 del account_cache[project.account]
 
-            delete_project(project.name)
+            schedule_deletion(delete_project, project.name)
 
             del project_cache[project]
 
+        else:
+            deadlines.append(unused_since + grace_period)
+
     accounts = get_accounts()
 
     for account in accounts:
@@ -253,20 +448,109 @@ def purge():
         if name in account_cache:
             del orphan_cache[name]
 
-        elif now - last_seen > 90.0:
-            delete_account(name)
+        elif now - last_seen >= grace_period:
+            schedule_deletion(delete_account, name)
 
             del orphan_cache[name]
 
+        else:
+            deadlines.append(last_seen + grace_period)
+
+    # Return when the next grace period expires so the check can be run
+    # again at exactly that time.
+
+    return deadlines and min(deadlines) or None
+
+# Rather than only checking on a fixed interval, checks are triggered
+# when the informers see objects being added or deleted, such as a pod
+# for a session going away, and at the time the next grace period
+# expires. A check is still done periodically in case anything is missed.
+
+wakeup = threading.Event()
+
+def trigger_purge(event_type, obj):
+    if event_type in ('ADDED', 'DELETED'):
+        wakeup.set()
+
+for informer in informers:
+    informer.add_listener(trigger_purge)
+
+# Projects created by older versions, including extra namespaces created
+# for a session, may not have the labels the informers select on, so
+# would never be deleted. When starting up, look for projects created by
+# this deployment which are missing the labels and add them, after which
+# they will be seen by the informers.
+
+def label_legacy_projects():
+    try:
+        projects, _ = retry_request(deletion_limiter, list_metadata,
+                api_client, namespace_resource)
+
+    except Exception as e:
+        print('ERROR: failed to list projects to label:', e)
+        return
+
+    for project in projects:
+        labels = project.metadata.labels or {}
+        annotations = project.metadata.annotations or {}
+
+        if labels.get('app') == application_name:
+            continue
+
+        if (annotations.get('spawner/requestor') != full_service_account_name or
+                annotations.get('spawner/namespace') != namespace or
+                annotations.get('spawner/deployment') != application_name):
+            continue
+
+        account = annotations.get('spawner/account') or ''
+        prefix = '%s-' % application_name
+
+        body = {
+            'metadata': {
+                'labels': {
+                    'app': application_name,
+                    'class': 'session'
+                }
+            }
+        }
+
+        if account.startswith(prefix):
+            body['metadata']['labels']['user'] = account[len(prefix):]
+
+        try:
+            print('INFO: labelling project %s' % project.metadata.name)
+
+            retry_request(deletion_limiter, namespace_resource.patch,
+                    name=project.metadata.name, body=body,
+                    content_type='application/merge-patch+json')
+
+        except Exception as e:
+            print('ERROR: failed to label project %s:' %
+                    project.metadata.name, e)
+
 def loop():
+    label_legacy_projects()
+
+    for informer in informers:
+        informer.wait_for_sync(timeout=60.0)
+
     while True:
+        wakeup.clear()
+
+        deadline = None
+
         try:
-            purge()
+            deadline = purge()
         except Exception as e:
             print('ERROR: unexpected exception:', e)
             pass
 
-        time.sleep(60.0)
+        timeout = resync_interval
+
+        if deadline is not None:
+            timeout = min(timeout, max(0.0, deadline - time.time()))
+
+        wakeup.wait(timeout)
 
 thread = threading.Thread(target=loop)
 thread.set_daemon = True